@@ -53,7 +53,8 @@ template_patterns = [
     'templates/*.html',
     'templates/*/*.html',
     'templates/*/*/*.html',
-    '*.data'
+    '*.data',
+    '*.table'
 ]
 
 package_data = dict(
@@ -0,0 +1,80 @@
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache
+
+from threespot.cache.registry import KeyRegistry
+
+"""
+Cache backends.
+"""
+
+class RegisteringCache(BaseCache):
+    """
+    A cache backend which wraps another configured cache and records the keys
+    of view-level and template-fragment entries as they are written (see
+    ``threespot.cache.registry``), so ``threespot.cache.expire`` can invalidate
+    them exactly. Its ``LOCATION`` is the alias of the cache to wrap::
+
+        CACHES = {
+            'default': {
+                'BACKEND': 'threespot.cache.backends.RegisteringCache',
+                'LOCATION': 'memcached',
+            },
+            'memcached': {
+                'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+                'LOCATION': '127.0.0.1:11211',
+            },
+        }
+
+    Keys are passed through to the wrapped cache untouched; its own key prefix
+    and version settings apply.
+    """
+
+    def __init__(self, location, params):
+        super(RegisteringCache, self).__init__(params)
+        self._cache = get_cache(location)
+        self.default_timeout = self._cache.default_timeout
+        self.registry = KeyRegistry(self._cache)
+
+    def add(self, key, value, timeout=None, version=None):
+        added = self._cache.add(key, value, timeout, version=version)
+        if added:
+            self.registry.register(key, timeout)
+        return added
+
+    def get(self, key, default=None, version=None):
+        return self._cache.get(key, default, version=version)
+
+    def set(self, key, value, timeout=None, version=None):
+        self._cache.set(key, value, timeout, version=version)
+        self.registry.register(key, timeout)
+
+    def delete(self, key, version=None):
+        self._cache.delete(key, version=version)
+
+    def get_many(self, keys, version=None):
+        return self._cache.get_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self._cache.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        return self._cache.incr(key, delta, version=version)
+
+    def decr(self, key, delta=1, version=None):
+        return self._cache.decr(key, delta, version=version)
+
+    def set_many(self, data, timeout=None, version=None):
+        self._cache.set_many(data, timeout, version=version)
+        for key in data:
+            self.registry.register(key, timeout)
+
+    def delete_many(self, keys, version=None):
+        self._cache.delete_many(keys, version=version)
+
+    def clear(self):
+        self._cache.clear()
+
+    def close(self, **kwargs):
+        close = getattr(self._cache, 'close', None)
+        if close:
+            close(**kwargs)
@@ -1,48 +1,132 @@
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest
-from django.utils.cache import get_cache_key
-from django.core.cache import cache
+from django.utils.cache import get_cache_key, _generate_cache_key, \
+    _generate_cache_header_key
+from django.core.cache import cache as default_cache, get_cache
 from django.utils.hashcompat import md5_constructor
 from django.utils.http import urlquote
 
+from threespot.cache.registry import get_fragment_family, get_view_family
+
 """
 This module contains functions for expiring higher-level django caches.
+
+If the cache is a ``threespot.cache.backends.RegisteringCache``, the keys it
+has recorded are deleted exactly, a whole family at a time; otherwise the keys
+are rebuilt.
 """
 
+def _get_cache(cache_alias=None):
+    if cache_alias:
+        return get_cache(cache_alias)
+    return default_cache
+
+def _make_request(path, variation=None):
+    # Create a fake GET request for ``path``. ``variation`` holds the
+    # ``META`` values of the headers the page varies on; a ``LANGUAGE_CODE``
+    # is set on the request, as ``LocaleMiddleware`` would.
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = path
+    if variation:
+        request.META.update(variation)
+        if 'LANGUAGE_CODE' in variation:
+            request.LANGUAGE_CODE = variation['LANGUAGE_CODE']
+    return request
+
+
 def expire_view_cache(view_name, args=[], kwargs={}, namespace=None,\
-    key_prefix=None):
+    key_prefix=None, cache_alias=None):
     """
-    This function allows you to invalidate any view-level cache. 
-    
+    This function allows you to invalidate any view-level cache.
+
     :param view_name: view function to invalidate or its named url pattern
-    
+
     :keyword args: any arguments passed to the view function
-    
+
     :keyword namepace: if an application namespace is used, pass that
-    
+
     :keyword key_prefix: the @cache_page decorator for the function (if any)
-    
-    """
 
-    # create a fake request object
-    request = HttpRequest()
-    # Loookup the request path:
+    :keyword cache_alias: the alias of the cache the view is stored in
+
+    """
+    cache = _get_cache(cache_alias)
     if namespace:
         view_name = namespace + ":" + view_name
-    request.path = reverse(view_name, args=args)
-    # get cache key, expire if the cached item exists:
-    key = get_cache_key(request, key_prefix=key_prefix)
+    path = reverse(view_name, args=args, kwargs=kwargs)
+    registry = getattr(cache, 'registry', None)
+    if registry is not None:
+        # Delete every recorded variation of the page in one round trip.
+        if key_prefix is None:
+            key_prefix = settings.CACHE_MIDDLEWARE_KEY_PREFIX
+        return bool(registry.delete_families(get_view_family(path, key_prefix)))
+    request = _make_request(path)
+    # get cache key, expire the cached item if there is one:
+    key = get_cache_key(request, key_prefix=key_prefix, cache=cache)
     if key:
-        if cache.get(key):
-            cache.set(key, None, 0)
+        cache.delete(key)
         return True
     return False
 
 
-def invalidate_template_cache(fragment_name, *variables):
+def expire_view_caches(views, key_prefix=None, cache_alias=None,\
+    variations=None):
+    """
+    Invalidates several view-level caches at once, in one ``delete_many``
+    call. ``views`` is a list of ``(view_name, args)`` pairs, where
+    ``view_name`` may include a namespace (e.g. ``"blog:article_detail"``).
+
+    With a ``RegisteringCache`` every recorded variation of every page is
+    deleted. Otherwise the header lists of all the pages are fetched in one
+    ``get_many`` call and the keys are rebuilt for each of ``variations``, a
+    list of dicts of the ``META`` values of the headers the pages vary on
+    (plus an optional ``LANGUAGE_CODE``), e.g.::
+
+        [{'HTTP_ACCEPT_LANGUAGE': 'en', 'LANGUAGE_CODE': 'en'},
+         {'HTTP_ACCEPT_LANGUAGE': 'fr', 'LANGUAGE_CODE': 'fr'}]
+
+    By default only the variation without any headers is expired. Returns the
+    deleted keys.
+    """
+    cache = _get_cache(cache_alias)
+    if key_prefix is None:
+        key_prefix = settings.CACHE_MIDDLEWARE_KEY_PREFIX
+    paths = [reverse(view_name, args=args) for view_name, args in views]
+    registry = getattr(cache, 'registry', None)
+    if registry is not None:
+        families = [get_view_family(path, key_prefix) for path in paths]
+        if not families:
+            return []
+        return registry.delete_families(*families)
+    requests = [_make_request(path, variation) for path in paths \
+        for variation in (variations or [None])
+    ]
+    header_keys = [_generate_cache_header_key(key_prefix, request) \
+        for request in requests
+    ]
+    headerlists = cache.get_many(list(set(header_keys)))
+    keys = []
+    for request, header_key in zip(requests, header_keys):
+        headerlist = headerlists.get(header_key)
+        if headerlist is None:
+            continue
+        # HEAD responses are cached under their own keys.
+        for method in ('GET', 'HEAD'):
+            request.method = method
+            keys.append(
+                _generate_cache_key(request, method, headerlist, key_prefix)
+            )
+    if keys:
+        cache.delete_many(keys)
+    return keys
+
+
+def invalidate_template_cache(fragment_name, *variables, **kwargs):
     """
     From http://djangosnippets.org/snippets/1593/
-    
+
     This function invalidates a template-fragment cache bit.
 
     say you have:
@@ -53,8 +137,51 @@ def invalidate_template_cache(fragment_name, *variables):
     To invalidate:
 
     invalidate_template_cache("user_cache", user.id)
+
+    Pass ``cache_alias`` to invalidate it in a cache other than the default.
     """
-    args = md5_constructor(u':'.join([urlquote(unicode(v)) for v in variables]))
-    cache_key = 'template.cache.%s.%s' % (fragment_name, args.hexdigest())
+    cache = _get_cache(kwargs.get('cache_alias'))
+    cache_key = get_template_cache_key(fragment_name, *variables)
     cache.delete(cache_key)
     return cache_key
+
+
+def invalidate_template_caches(fragments, cache_alias=None):
+    """
+    Invalidates several template-fragment cache bits in one ``delete_many``
+    call. ``fragments`` is a list of ``(fragment_name, variables)`` pairs.
+    Returns the deleted keys.
+    """
+    keys = [get_template_cache_key(name, *variables) \
+        for name, variables in fragments
+    ]
+    if keys:
+        _get_cache(cache_alias).delete_many(keys)
+    return keys
+
+
+def get_template_cache_key(fragment_name, *variables):
+    """
+    Returns the key the ``{% cache %}`` tag stores a fragment under.
+    """
+    args = md5_constructor(u':'.join([urlquote(unicode(v)) for v in variables]))
+    return 'template.cache.%s.%s' % (fragment_name, args.hexdigest())
+
+
+def invalidate_template_fragments(fragment_name, cache_alias=None):
+    """
+    Invalidates every cached variation of a template fragment, whatever
+    variables it was cached with, in one ``delete_many`` call. The cache must
+    be a ``RegisteringCache``. Returns the deleted keys.
+
+    To invalidate every ``user_cache`` fragment from the example above::
+
+        invalidate_template_fragments("user_cache")
+    """
+    registry = getattr(_get_cache(cache_alias), 'registry', None)
+    if registry is None:
+        raise ValueError(
+            "Template fragments can only be invalidated together in a "
+            "RegisteringCache."
+        )
+    return registry.delete_families(get_fragment_family(fragment_name))
@@ -0,0 +1,120 @@
+import re
+
+from django.conf import settings
+from django.utils.encoding import iri_to_uri
+from django.utils.hashcompat import md5_constructor
+
+"""
+This module keeps track of the keys of view-level and template-fragment cache
+entries as they are written, grouped into "families": every variation of one
+view URL, or every variation of one template fragment. Invalidation can then
+delete a whole family with a single ``delete_many`` call instead of rebuilding
+keys one at a time.
+
+Keys are recorded by the ``RegisteringCache`` backend in 
+``threespot.cache.backends``, which stores each family's list of keys in the
+cache it wraps.
+"""
+
+REGISTRY_KEY_PREFIX = 'threespot.cache.registry.'
+
+# The most keys recorded per family (e.g. for a page which varies on
+# ``Cookie``), so that its key list stays well within memcached's 1 MB item
+# limit.
+REGISTRY_MAX_KEYS = getattr(settings, 'THREESPOT_CACHE_REGISTRY_MAX_KEYS', 500)
+
+# Page keys look like "views.decorators.cache.cache_page.<key prefix>.
+# [<method>.]<path hash>.<header hash>", with an optional language suffix; 
+# every method, header (and language) variation of a URL belongs to the same
+# family.
+_view_key_re = re.compile(
+    r'^views\.decorators\.cache\.cache_page\.(.*?)\.(?:[A-Z]+\.)?'
+    r'([0-9a-f]{32})\.[0-9a-f]{32}(?:\.(?![0-9a-f]{32}$)[^.]+)?$'
+)
+# Fragment keys look like "template.cache.<fragment name>.<variables hash>".
+_fragment_key_re = re.compile(r'^template\.cache\.(.*)\.[0-9a-f]{32}$')
+
+
+def get_key_family(key):
+    """
+    Return the name of the family the given view-level or template-fragment
+    cache key belongs to, or None if it is neither.
+    """
+    match = _view_key_re.match(key)
+    if match:
+        return 'view:%s.%s' % match.groups()
+    match = _fragment_key_re.match(key)
+    if match:
+        return 'fragment:' + match.group(1)
+    return None
+
+def get_view_family(path, key_prefix=''):
+    """
+    Return the name of the family of the page keys cached for the given URL
+    path by ``cache_page`` or the cache middleware using ``key_prefix``.
+    """
+    path_hash = md5_constructor(iri_to_uri(path)).hexdigest()
+    return 'view:%s.%s' % (key_prefix, path_hash)
+
+def get_fragment_family(fragment_name):
+    """ Return the name of the family of a template fragment's keys."""
+    return 'fragment:' + fragment_name
+
+
+class KeyRegistry(object):
+    """
+    Records cache keys by family in the given ``cache``.
+    
+    Registering a key costs a read (and, for a new key, a write) of the
+    family's key list. This only happens when a view or fragment is written to
+    the cache, i.e. on a cache miss. Concurrent writers may occasionally drop a
+    key from a list; such an entry simply lives out its timeout.
+
+    A family keeps at most ``THREESPOT_CACHE_REGISTRY_MAX_KEYS`` keys: when a
+    new key would exceed it, the oldest keys are dropped and their entries
+    deleted, so that no entry outlives its place in the list.
+    """
+    
+    def __init__(self, cache):
+        self.cache = cache
+    
+    def _registry_key(self, family):
+        return REGISTRY_KEY_PREFIX + md5_constructor(family).hexdigest()
+    
+    def register(self, key, timeout=None):
+        """
+        Record ``key`` if it is a view or fragment key. The family's key list
+        is kept for as long as the entry.
+        """
+        family = get_key_family(key)
+        if not family:
+            return False
+        registry_key = self._registry_key(family)
+        keys = self.cache.get(registry_key) or []
+        if key not in keys:
+            keys.append(key)
+            if len(keys) > REGISTRY_MAX_KEYS:
+                self.cache.delete_many(keys[:-REGISTRY_MAX_KEYS])
+                keys = keys[-REGISTRY_MAX_KEYS:]
+            if timeout is None:
+                timeout = self.cache.default_timeout
+            self.cache.set(registry_key, keys, timeout)
+        return True
+    
+    def get_keys(self, *families):
+        """ Return all the keys recorded for the given families."""
+        registry_keys = [self._registry_key(f) for f in families]
+        keys = []
+        for family_keys in self.cache.get_many(registry_keys).values():
+            keys.extend(family_keys)
+        return keys
+    
+    def delete_families(self, *families):
+        """
+        Delete every recorded key of the given families, along with their key
+        lists, in one ``delete_many`` call. Returns the deleted entry keys.
+        """
+        keys = self.get_keys(*families)
+        registry_keys = [self._registry_key(f) for f in families]
+        self.cache.delete_many(keys + registry_keys)
+        return keys
@@ -0,0 +1,141 @@
+import threading
+from functools import wraps
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache as default_cache, get_cache
+from django.middleware.cache import CacheMiddleware
+from django.utils.decorators import decorator_from_middleware_with_args
+from django.utils.hashcompat import md5_constructor
+
+"""
+Generational cache tags.
+
+A tag (e.g. ``"article:42"``) names something that cached entries depend on.
+Each tag has a version stored in the cache, and the versions of an entry's
+tags are folded into its key. Bumping a tag gives it a new version, so every
+view and fragment entry that carries it is stale at once, without having to
+find their keys; the stale entries simply live out their timeouts.
+"""
+
+TAG_KEY_PREFIX = 'threespot.cache.tag.'
+
+# Tag versions must outlive the entries that carry them.
+TAG_TIMEOUT = getattr(settings, 'THREESPOT_CACHE_TAG_TIMEOUT',
+    60 * 60 * 24 * 30
+)
+
+
+def _get_cache(cache_alias=None):
+    if cache_alias:
+        return get_cache(cache_alias)
+    return default_cache
+
+def _new_version():
+    # A random version, so a tag whose version was evicted never gets one of
+    # its old versions back.
+    return uuid4().hex[:12]
+
+
+def get_tag_versions(tags, cache_alias=None):
+    """
+    Return a list of the current versions of ``tags``, in the same order,
+    reading them in one ``get_many`` call. Tags without a version are given
+    one.
+    """
+    cache = _get_cache(cache_alias)
+    tag_keys = [TAG_KEY_PREFIX + tag for tag in tags]
+    versions = cache.get_many(tag_keys)
+    missing = dict(
+        (key, _new_version()) for key in tag_keys if key not in versions
+    )
+    if missing:
+        cache.set_many(missing, TAG_TIMEOUT)
+        versions.update(missing)
+    return [versions[key] for key in tag_keys]
+
+def get_tags_hash(tags, cache_alias=None):
+    """
+    Return a hash of the current versions of ``tags``, which changes whenever
+    one of them is bumped.
+    """
+    tags = sorted(set(tags))
+    versions = get_tag_versions(tags, cache_alias)
+    return md5_constructor(
+        u':'.join([u'%s=%s' % tv for tv in zip(tags, versions)])
+    ).hexdigest()
+
+def bump_tags(*tags, **kwargs):
+    """
+    Give each tag a new version, making every cache entry that carries it
+    stale, in one ``set_many`` call. Pass ``cache_alias`` to bump the tags in
+    a cache other than the default.
+
+        bump_tags("article:42")
+    """
+    cache = _get_cache(kwargs.get('cache_alias'))
+    cache.set_many(
+        dict((TAG_KEY_PREFIX + tag, _new_version()) for tag in tags),
+        TAG_TIMEOUT
+    )
+
+
+class _TaggedCacheMiddleware(CacheMiddleware):
+    """
+    A ``CacheMiddleware`` whose key prefix is the one set on each request as
+    ``_tagged_key_prefix``, which carries the versions of the view's tags.
+    Like ``cache_page``, ``cache_page_tagged`` creates one per view, and so
+    one cache connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super(_TaggedCacheMiddleware, self).__init__(*args, **kwargs)
+
+    # The middleware is shared by the threads handling requests.
+    def _get_key_prefix(self):
+        return getattr(self._local, 'key_prefix', self._key_prefix)
+
+    def _set_key_prefix(self, key_prefix):
+        self._key_prefix = key_prefix
+
+    key_prefix = property(_get_key_prefix, _set_key_prefix)
+
+    def process_request(self, request):
+        self._local.key_prefix = request._tagged_key_prefix
+        return super(_TaggedCacheMiddleware, self).process_request(request)
+
+    def process_response(self, request, response):
+        self._local.key_prefix = request._tagged_key_prefix
+        return super(_TaggedCacheMiddleware, self).process_response(request,
+            response
+        )
+
+
+def cache_page_tagged(timeout, tags, key_prefix='', cache_alias=None):
+    """
+    Like Django's ``cache_page``, but the cached page carries ``tags``, and
+    bumping any of them expires it. ``tags`` is either a list of tags or a
+    function which is called with the view's arguments and returns one::
+
+        @cache_page_tagged(60 * 15, lambda request, pk: ['article:%s' % pk])
+        def article_detail(request, pk):
+            ...
+    """
+    def decorator(view_func):
+        cached_view = decorator_from_middleware_with_args(
+            _TaggedCacheMiddleware
+        )(cache_timeout=timeout, key_prefix=key_prefix,
+            cache_alias=cache_alias
+        )(view_func)
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            if callable(tags):
+                view_tags = tags(request, *args, **kwargs)
+            else:
+                view_tags = tags
+            tags_hash = get_tags_hash(view_tags, cache_alias)
+            request._tagged_key_prefix = '%s.%s' % (key_prefix, tags_hash)
+            return cached_view(request, *args, **kwargs)
+        return _wrapped_view
+    return decorator
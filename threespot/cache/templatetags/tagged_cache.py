@@ -0,0 +1,77 @@
+from django import template
+from django.core.cache import cache as default_cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import urlquote
+
+from threespot.cache.tags import get_tags_hash
+
+register = template.Library()
+
+class TaggedCacheNode(template.Node):
+
+    def __init__(self, nodelist, expire_time_var, fragment_name, vary_on,\
+        tag_vars):
+        self.nodelist = nodelist
+        self.expire_time_var = template.Variable(expire_time_var)
+        self.fragment_name = fragment_name
+        self.vary_on = [template.Variable(v) for v in vary_on]
+        self.tag_vars = [template.Variable(t) for t in tag_vars]
+
+    def render(self, context):
+        try:
+            expire_time = self.expire_time_var.resolve(context)
+        except template.VariableDoesNotExist:
+            raise template.TemplateSyntaxError(
+                '"tagged_cache" tag got an unknown variable: %r' % \
+                self.expire_time_var.var
+            )
+        try:
+            expire_time = int(expire_time)
+        except (ValueError, TypeError):
+            raise template.TemplateSyntaxError(
+                '"tagged_cache" tag got a non-integer timeout value: %r' % \
+                expire_time
+            )
+        tags = [unicode(t.resolve(context)) for t in self.tag_vars]
+        # The key has the same form as the {% cache %} tag's, with the tag
+        # versions hashed in along with the variables.
+        variables = [urlquote(v.resolve(context)) for v in self.vary_on]
+        variables.append(get_tags_hash(tags))
+        args = md5_constructor(u':'.join(variables))
+        cache_key = 'template.cache.%s.%s' % (
+            self.fragment_name, args.hexdigest()
+        )
+        value = default_cache.get(cache_key)
+        if value is None:
+            value = self.nodelist.render(context)
+            default_cache.set(cache_key, value, expire_time)
+        return value
+
+def do_tagged_cache(parser, token):
+    """
+    Like the ``{% cache %}`` tag, but the fragment also carries the cache tags
+    listed after ``tags``. Bumping any of them (see
+    ``threespot.cache.tags.bump_tags``) expires the fragment::
+
+        {% load tagged_cache %}
+        {% tagged_cache 600 sidebar request.user.id tags article_tag %}
+            .. sidebar ..
+        {% endtagged_cache %}
+    """
+    nodelist = parser.parse(('endtagged_cache',))
+    parser.delete_first_token()
+    bits = token.contents.split()
+    if 'tags' not in bits:
+        raise template.TemplateSyntaxError(
+            u"'%r' tag requires a list of tags after 'tags'." % bits[0]
+        )
+    tags_index = bits.index('tags')
+    tag_vars = bits[tags_index + 1:]
+    bits = bits[:tags_index]
+    if len(bits) < 3 or not tag_vars:
+        raise template.TemplateSyntaxError(
+            u"'%r' tag requires at least 2 arguments and one tag." % bits[0]
+        )
+    return TaggedCacheNode(nodelist, bits[1], bits[2], bits[3:], tag_vars)
+
+register.tag('tagged_cache', do_tagged_cache)
@@ -1,2 +1,3 @@
 from countries import countries
-from geo import distance_angular, distance_miles, Point
\ No newline at end of file
+from geo import distance_angular, distance_miles, distances_angular, \
+    distances_miles, Point
\ No newline at end of file
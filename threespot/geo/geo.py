@@ -1,22 +1,70 @@
+from array import array
 from math import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 GREAT_CIRCLE_MILES = 3959.873
 
-class Point:
+class Point(object):
+    """
+    A point on the globe, with its latitude and longitude in radians.
+
+    Points are immutable and use ``__slots__``, so they are cheap to keep by
+    the thousand. The sine and cosine of the latitude are computed the first
+    time a distance is measured from the point and cached, so measuring many
+    distances from one point only does that work once; pass
+    ``precompute=True`` to compute them up front.
+    """
 
-    def __init__(self, lat, long):
-        self.latitude = lat
+    __slots__ = ('_latitude', '_longitude', '_sin_lat', '_cos_lat')
+
+    def __init__(self, lat, long, precompute=False):
         assert - pi/2 <= lat <= pi/2, (
             "Latitude must be in radians and between -pi/2 and pi/2"
         )
-        self.longitude = long
-        assert - pi <= lat <= pi, (
-            "Latitude must be in radians and between -pi and pi"
+        assert - pi <= long <= pi, (
+            "Longitude must be in radians and between -pi and pi"
         )
+        self._latitude = lat
+        self._longitude = long
+        if precompute:
+            self._sin_lat = sin(lat)
+            self._cos_lat = cos(lat)
+        else:
+            self._sin_lat = self._cos_lat = None
 
     @classmethod
-    def from_degrees(cls, lat, long):
-        return cls((lat*pi)/180, (long*pi)/180)
+    def from_degrees(cls, lat, long, precompute=False):
+        return cls((lat*pi)/180, (long*pi)/180, precompute=precompute)
+
+    @property
+    def latitude(self):
+        return self._latitude
+
+    @property
+    def longitude(self):
+        return self._longitude
+
+    @property
+    def sin_lat(self):
+        if self._sin_lat is None:
+            self._sin_lat = sin(self._latitude)
+        return self._sin_lat
+
+    @property
+    def cos_lat(self):
+        if self._cos_lat is None:
+            self._cos_lat = cos(self._latitude)
+        return self._cos_lat
+
+    def __reduce__(self):
+        return (self.__class__, (self._latitude, self._longitude))
+
+    def __repr__(self):
+        return "Point(%r, %r)" % (self._latitude, self._longitude)
 
 
 def distance_angular(point1, point2):
@@ -25,10 +73,10 @@ def distance_angular(point1, point2):
     delta_long = point1.longitude - point2.longitude
     cos_delta_long = cos(delta_long)
     sin_delta_long = sin(delta_long)
-    cos_lat_1 = cos(point1.latitude)
-    sin_lat_1 = sin(point1.latitude)
-    cos_lat_2 = cos(point2.latitude)
-    sin_lat_2 = sin(point2.latitude)
+    cos_lat_1 = point1.cos_lat
+    sin_lat_1 = point1.sin_lat
+    cos_lat_2 = point2.cos_lat
+    sin_lat_2 = point2.sin_lat
     numerator = sqrt((cos_lat_2*sin_delta_long)**2 + \
         (cos_lat_1*sin_lat_2 - sin_lat_1*cos_lat_2*cos_delta_long)**2)
     denominator = sin_lat_1*sin_lat_2 + cos_lat_1*cos_lat_2*cos_delta_long
@@ -45,3 +93,110 @@ def distance_miles(point1, point2):
         1794
     """
     return GREAT_CIRCLE_MILES * distance_angular(point1, point2)
+
+def _coordinates(points):
+    """
+    Split a sequence of ``Point`` objects or ``(latitude, longitude)`` tuples
+    (in radians) into a sequence of latitudes and a sequence of longitudes.
+    """
+    latitudes, longitudes = array('d'), array('d')
+    for point in points:
+        if isinstance(point, Point):
+            latitudes.append(point.latitude)
+            longitudes.append(point.longitude)
+        else:
+            latitudes.append(point[0])
+            longitudes.append(point[1])
+    return latitudes, longitudes
+
+def _distances_angular_numpy(lat1, long1, lat2, long2):
+    lat1, long1 = numpy.asarray(lat1), numpy.asarray(long1)
+    lat2, long2 = numpy.asarray(lat2), numpy.asarray(long2)
+    delta_long = long1 - long2
+    cos_delta_long = numpy.cos(delta_long)
+    sin_delta_long = numpy.sin(delta_long)
+    cos_lat_1 = numpy.cos(lat1)
+    sin_lat_1 = numpy.sin(lat1)
+    cos_lat_2 = numpy.cos(lat2)
+    sin_lat_2 = numpy.sin(lat2)
+    numerator = numpy.sqrt((cos_lat_2*sin_delta_long)**2 + \
+        (cos_lat_1*sin_lat_2 - sin_lat_1*cos_lat_2*cos_delta_long)**2)
+    denominator = sin_lat_1*sin_lat_2 + cos_lat_1*cos_lat_2*cos_delta_long
+    return numpy.arctan2(numerator, denominator)
+
+def _distances_angular_python(origin, lat1, long1, lat2, long2):
+    distances = array('d')
+    if origin is not None:
+        # A single origin: reuse its cached trig terms.
+        cos_lat_1, sin_lat_1 = origin.cos_lat, origin.sin_lat
+        for lat_2, long_2 in zip(lat2, long2):
+            delta_long = long1 - long_2
+            cos_delta_long = cos(delta_long)
+            cos_lat_2 = cos(lat_2)
+            sin_lat_2 = sin(lat_2)
+            numerator = sqrt((cos_lat_2*sin(delta_long))**2 + \
+                (cos_lat_1*sin_lat_2 - sin_lat_1*cos_lat_2*cos_delta_long)**2)
+            denominator = sin_lat_1*sin_lat_2 + \
+                cos_lat_1*cos_lat_2*cos_delta_long
+            distances.append(atan2(numerator, denominator))
+    else:
+        for lat_1, long_1, lat_2, long_2 in zip(lat1, long1, lat2, long2):
+            delta_long = long_1 - long_2
+            cos_delta_long = cos(delta_long)
+            cos_lat_1 = cos(lat_1)
+            sin_lat_1 = sin(lat_1)
+            cos_lat_2 = cos(lat_2)
+            sin_lat_2 = sin(lat_2)
+            numerator = sqrt((cos_lat_2*sin(delta_long))**2 + \
+                (cos_lat_1*sin_lat_2 - sin_lat_1*cos_lat_2*cos_delta_long)**2)
+            denominator = sin_lat_1*sin_lat_2 + \
+                cos_lat_1*cos_lat_2*cos_delta_long
+            distances.append(atan2(numerator, denominator))
+    return distances
+
+def distances_angular(origins, points):
+    """
+    Great-circle distances (in radians) computed in a single pass.
+
+    ``origins`` is either a single ``Point``, whose distance to every item
+    in ``points`` is computed, or a sequence the same length as ``points``,
+    in which case the distances between corresponding items are computed.
+    Sequence items may be ``Point`` objects or ``(latitude, longitude)``
+    tuples in radians, such as the values of ``zipcode.ZIPS``.
+
+    Returns a NumPy array if NumPy is installed, or an ``array('d')``
+    otherwise.
+    """
+    lat2, long2 = _coordinates(points)
+    if isinstance(origins, Point):
+        lat1, long1 = origins.latitude, origins.longitude
+    else:
+        lat1, long1 = _coordinates(origins)
+        if len(lat1) != len(lat2):
+            raise ValueError(
+                "Expected %d origins, got %d." % (len(lat2), len(lat1))
+            )
+    if numpy is not None:
+        return _distances_angular_numpy(lat1, long1, lat2, long2)
+    return _distances_angular_python(
+        isinstance(origins, Point) and origins or None,
+        lat1, long1, lat2, long2
+    )
+
+def distances_miles(origins, points):
+    """
+    Great-circle distances (in miles) computed in a single pass; see
+    ``distances_angular`` for the arguments. Distances from Nashville
+    International Airport (BNA) and Los Angeles International Airport (LAX):
+
+        >>> bna = Point.from_degrees(36.12, -86.67)
+        >>> lax = Point.from_degrees(33.94, -118.40)
+        >>> [int(d) for d in distances_miles(bna, [bna, lax])]
+        [0, 1794]
+        >>> [int(d) for d in distances_miles([bna, lax], [lax, lax])]
+        [1794, 0]
+    """
+    distances = distances_angular(origins, points)
+    if numpy is not None:
+        return GREAT_CIRCLE_MILES * distances
+    return array('d', (GREAT_CIRCLE_MILES * d for d in distances))
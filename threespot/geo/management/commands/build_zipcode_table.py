@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from threespot.geo import zipcode
+
+class Command(BaseCommand):
+    
+    """
+    This Django management command compiles the plain-text zipcode data into
+    the binary table that ``threespot.geo.zipcode`` memory-maps. It is run
+    thusly:
+        
+        $>./manage.py build_zipcode_table [source] [destination]
+    
+    By default it reads the ``zipcode.data`` file and writes ``zipcode.table``
+    next to the ``threespot.geo.zipcode`` module. Run it again whenever the
+    data file changes; running processes keep using the table they mapped
+    until they are restarted.
+    
+    """
+    
+    args = '[source] [destination]'
+    help = 'Compiles the zipcode data into a memory-mappable binary table.'
+    
+    def handle(self, *args, **options):
+        if len(args) > 2:
+            raise CommandError("Usage: build_zipcode_table %s" % self.args)
+        source = len(args) > 0 and args[0] or zipcode.DATA_PATH
+        destination = len(args) > 1 and args[1] or zipcode.TABLE_PATH
+        try:
+            count = zipcode.write_table(
+                zipcode.parse_zips(source),
+                destination
+            )
+        except (IOError, OSError, ValueError), e:
+            raise CommandError(
+                "Could not build the zipcode table: %s" % e
+            )
+        self.stdout.write(
+            "Wrote %d zip codes to: %s.\n" % (count, destination)
+        )
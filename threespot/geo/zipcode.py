@@ -1,54 +1,460 @@
 """Geographical tools dealing with US zipcodes.
 
-ZIPS is a dictionary of {5-digit-zip: (latitude, longitude)}
+ZIPS is a read-only, dictionary-like mapping of
+{5-digit-zip: (latitude, longitude)}
 
-The zip codes are strings and latitude/longitude are in radians. 
+The zip codes are strings and latitude/longitude are in radians.
+
+The zips are stored in a compact binary table of fixed-width records sorted
+by zip code, and lookups are done by binary search. If a compiled table (see
+the ``build_zipcode_table`` management command) sits next to this module it is
+memory-mapped, so import is nearly free and forked workers share its pages.
+Otherwise the plain-text ``zipcode.data`` file is packed into the same format
+in memory. Either way, nothing is loaded until ZIPS is first used (or ``warm``
+is called).
+
+Radius and nearest-zip searches go through a spatial index which buckets
+the zips into a latitude/longitude grid; it is built once per process, the
+first time it is needed.
 """
 
-from threespot.geo.geo import distance_miles, Point
+import cPickle
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import Mapping, OrderedDict
+from math import asin, atan2, cos, floor, pi, sin, sqrt
+
+from threespot.geo.geo import distance_miles, distances_miles, Point, \
+    GREAT_CIRCLE_MILES
+
+HERE = os.path.dirname(__file__)
+DATA_PATH = os.path.join(HERE, 'zipcode.data')
+TABLE_PATH = os.path.join(HERE, 'zipcode.table')
 
-ZIPS = {}
+TABLE_MAGIC = 'ZIPT'
+TABLE_VERSION = 1
+# Header: magic, format version, number of records.
+_HEADER = struct.Struct('<4sII')
+# Record: zip code, latitude and longitude (in radians).
+_RECORD = struct.Struct('<5sdd')
+ZIP_LENGTH = 5
 
-def _load_zips(dict):
-    """Load up the zips in a fast and memory light way.
+# The size of the spatial index's grid cells (in radians): about 35 miles of
+# latitude, which keeps typical radius searches to a handful of cells.
+GRID_CELL_SIZE = 0.5 * pi / 180
 
-    Tests indicated that loading the zips this way increased memory by about
-    5Mb, as opposed to 80MB for generated python code.
+# The number of zip-to-zip distances remembered by ``zip_to_zip_miles``.
+DISTANCE_CACHE_SIZE = 4096
+
+
+def parse_zips(path=DATA_PATH):
+    """
+    Yield ``(zip, latitude, longitude)`` tuples from a plain-text zipcode
+    file, with the coordinates converted to radians.
     """
-    import os
-    from math import pi
-    here = os.path.dirname(__file__)
-    source = open(os.path.join(here, 'zipcode.data'), 'r')
+    source = open(path, 'r')
     try:
-        line = source.readline()
-        while line:
-            zip, lat, long = line.strip().split()
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            zip, lat, long = line.split()
             # fix quadrant and convert to radians
             lat = (float(lat) * pi) / 180
             long = - (float(long) * pi) / 180
-            ZIPS[zip] = (lat, long)
-            line = source.readline()
+            yield zip, lat, long
     finally:
         source.close()
 
-_load_zips(ZIPS)
-del _load_zips
+def pack_table(zips):
+    """
+    Pack an iterable of ``(zip, latitude, longitude)`` tuples into the binary
+    table format understood by ``ZipTable``.
+    """
+    records = sorted(zips)
+    for zip, lat, long in records:
+        if len(zip) != ZIP_LENGTH:
+            raise ValueError("Invalid zip code: %r" % zip)
+    chunks = [_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(records))]
+    chunks.extend(_RECORD.pack(*record) for record in records)
+    return ''.join(chunks)
+
+def write_table(zips, path=TABLE_PATH):
+    """
+    Write a binary zipcode table to ``path``.
+
+    The table is written to a temporary file which is then renamed over the
+    destination, so processes which have the old table mapped are unaffected.
+    Returns the number of zips written.
+    """
+    data = pack_table(zips)
+    tmp_path = path + '.tmp'
+    dest = open(tmp_path, 'wb')
+    try:
+        dest.write(data)
+    finally:
+        dest.close()
+    os.rename(tmp_path, path)
+    return (len(data) - _HEADER.size) // _RECORD.size
+
+
+class ZipTable(Mapping):
+    """
+    A read-only mapping of {zip: (latitude, longitude)} backed by a packed
+    binary table (any object supporting the buffer interface, e.g. a string
+    or an ``mmap``). Nothing is unpacked until it is looked up.
+    """
+
+    def __init__(self, buffer):
+        if len(buffer) < _HEADER.size:
+            raise ValueError("Not a zipcode table.")
+        magic, version, count = _HEADER.unpack_from(buffer, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError(
+                "Not a version %d zipcode table." % TABLE_VERSION
+            )
+        if len(buffer) < _HEADER.size + count * _RECORD.size:
+            raise ValueError("The zipcode table is truncated.")
+        self._buffer = buffer
+        self._count = count
+        self._points = {}
+
+    @classmethod
+    def from_file(cls, path=TABLE_PATH):
+        """ Memory-map a compiled zipcode table."""
+        source = open(path, 'rb')
+        try:
+            buffer = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The mapping stays valid after the file is closed.
+            source.close()
+        return cls(buffer)
+
+    @classmethod
+    def from_text(cls, path=DATA_PATH):
+        """ Build an in-memory table from a plain-text zipcode file."""
+        return cls(pack_table(parse_zips(path)))
+
+    def _offset(self, index):
+        return _HEADER.size + index * _RECORD.size
+
+    def _key(self, index):
+        offset = self._offset(index)
+        return self._buffer[offset:offset + ZIP_LENGTH]
+
+    def _record(self, index):
+        return _RECORD.unpack_from(self._buffer, self._offset(index))
+
+    def index(self, zip):
+        """
+        Return the position of ``zip`` in the table, or -1 if it is not
+        present.
+        """
+        if isinstance(zip, unicode):
+            try:
+                zip = zip.encode('ascii')
+            except UnicodeError:
+                return -1
+        if not isinstance(zip, str) or len(zip) != ZIP_LENGTH:
+            return -1
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key = self._key(middle)
+            if key < zip:
+                low = middle + 1
+            elif key > zip:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    def point(self, zip):
+        """
+        Return the location of ``zip`` as a ``Point`` with its trig terms
+        precomputed. Points are cached, so repeated lookups of the same zip
+        don't repeat any work.
+        """
+        try:
+            return self._points[zip]
+        except KeyError:
+            point = Point(*self[zip], precompute=True)
+            self._points[zip] = point
+            return point
+
+    def __getitem__(self, zip):
+        index = self.index(zip)
+        if index < 0:
+            raise KeyError(zip)
+        return self._record(index)[1:]
+
+    def __contains__(self, zip):
+        return self.index(zip) >= 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self._key(index)
+
+    def iteritems(self):
+        for index in xrange(self._count):
+            record = self._record(index)
+            yield record[0], record[1:]
+
+
+class ZipIndex(object):
+    """
+    A spatial index over a mapping of {zip: (latitude, longitude)} which
+    buckets the zips into a grid of ``cell_size`` radian cells.
+
+    Searches only visit the cells overlapping the bounding box of the search
+    circle and discard zips outside the bounding box before computing the
+    exact great-circle distance. The index holds precomputed trig terms for
+    every zip, so that distance is cheap.
+    """
+
+    def __init__(self, zips, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.columns = int(round(2 * pi / cell_size))
+        self.cells = {}
+        for zip, (lat, long) in zips.iteritems():
+            cell = (self._row(lat), self._column(long))
+            self.cells.setdefault(cell, []).append(
+                (zip, lat, long, sin(lat), cos(lat))
+            )
+
+    def _row(self, lat):
+        return int(floor(lat / self.cell_size))
+
+    def _column(self, long):
+        return int(floor((long + pi) / self.cell_size)) % self.columns
+
+    def within(self, point, miles):
+        """
+        Return a list of ``(zip, distance in miles)`` tuples for the zips
+        within ``miles`` of the given ``Point``, nearest first.
+        """
+        radius = miles / GREAT_CIRCLE_MILES
+        lat, long = point.latitude, point.longitude
+        min_lat, max_lat = lat - radius, lat + radius
+        # The half-width in longitude of the circle's bounding box, unless the
+        # circle covers a pole (in which case every longitude qualifies).
+        if max_lat >= pi / 2 or min_lat <= - pi / 2 or radius >= pi / 2 \
+            or sin(radius) >= cos(lat):
+            long_radius = pi
+        else:
+            long_radius = asin(sin(radius) / cos(lat))
+        if long_radius >= pi:
+            columns = xrange(self.columns)
+        else:
+            first = self._column(long - long_radius)
+            count = min(
+                self.columns,
+                int(2 * long_radius / self.cell_size) + 2
+            )
+            columns = set((first + i) % self.columns for i in xrange(count))
+        sin_lat, cos_lat = point.sin_lat, point.cos_lat
+        results = []
+        for row in xrange(self._row(min_lat), self._row(max_lat) + 1):
+            for column in columns:
+                cell = self.cells.get((row, column), ())
+                for zip_code, zip_lat, zip_long, zip_sin, zip_cos in cell:
+                    # Bounding box prefilter.
+                    if not min_lat <= zip_lat <= max_lat:
+                        continue
+                    delta_long = long - zip_long
+                    if abs(delta_long) > pi:
+                        delta_long = 2 * pi - abs(delta_long)
+                    if abs(delta_long) > long_radius:
+                        continue
+                    # This is ``distance_angular``, inlined for speed.
+                    cos_delta_long = cos(delta_long)
+                    numerator = sqrt((zip_cos * sin(delta_long)) ** 2 + \
+                        (cos_lat * zip_sin - \
+                         sin_lat * zip_cos * cos_delta_long) ** 2)
+                    denominator = sin_lat * zip_sin + \
+                        cos_lat * zip_cos * cos_delta_long
+                    distance = GREAT_CIRCLE_MILES * \
+                        atan2(numerator, denominator)
+                    if distance <= miles:
+                        results.append((zip_code, distance))
+        results.sort(key=lambda result: result[1])
+        return results
+
+    def nearest(self, point, n, initial_miles=10):
+        """
+        Return a list of ``(zip, distance in miles)`` tuples for the ``n`` zips
+        nearest to the given ``Point``, nearest first.
+
+        The search radius starts at ``initial_miles`` and doubles until it
+        holds at least ``n`` zips (or covers the whole globe).
+        """
+        if n <= 0:
+            return []
+        miles = initial_miles
+        while True:
+            results = self.within(point, miles)
+            if len(results) >= n or miles > pi * GREAT_CIRCLE_MILES:
+                return results[:n]
+            miles *= 2
+
+
+def _load_zips():
+    """
+    Map the compiled table if it exists, otherwise fall back to packing the
+    plain-text data.
+    """
+    if os.path.exists(TABLE_PATH):
+        return ZipTable.from_file(TABLE_PATH)
+    return ZipTable.from_text(DATA_PATH)
+
+_LOCK = threading.RLock()
+_TABLE = []
+_INDEX = []
+
+def get_table():
+    """ Return the process-wide ``ZipTable``, loading it on first use."""
+    if not _TABLE:
+        with _LOCK:
+            if not _TABLE:
+                _TABLE.append(_load_zips())
+    return _TABLE[0]
+
+def get_index():
+    """ Return the process-wide spatial index of ``ZIPS``."""
+    if not _INDEX:
+        with _LOCK:
+            if not _INDEX:
+                _INDEX.append(ZipIndex(get_table()))
+    return _INDEX[0]
+
+def warm(index=True):
+    """
+    Load the zip table, and the spatial index unless ``index`` is False, now
+    rather than on first use. Preforking servers can call this before they
+    fork so that the workers share the loaded data.
+    """
+    get_table()
+    if index:
+        get_index()
+
+
+class LazyZipTable(Mapping):
+    """
+    A stand-in for the process-wide ``ZipTable`` which loads it the first
+    time it is accessed.
+    """
+
+    def point(self, zip):
+        return get_table().point(zip)
+
+    def __getitem__(self, zip):
+        return get_table()[zip]
+
+    def __contains__(self, zip):
+        return zip in get_table()
+
+    def __len__(self):
+        return len(get_table())
+
+    def __iter__(self):
+        return iter(get_table())
+
+    def iteritems(self):
+        return get_table().iteritems()
+
+ZIPS = LazyZipTable()
+
+
+class DistanceCache(object):
+    """
+    A bounded, least-recently-used cache of distances keyed on unordered
+    pairs of zip codes, which counts its hits and misses.
+    """
+
+    def __init__(self, maxsize=DISTANCE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._distances = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(zip1, zip2):
+        if zip2 < zip1:
+            return zip2, zip1
+        return zip1, zip2
+
+    def get(self, zip1, zip2):
+        """ Return the cached distance between two zips, or None."""
+        key = self._key(zip1, zip2)
+        with self._lock:
+            try:
+                distance = self._distances.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert to mark the pair as most recently used.
+            self._distances[key] = distance
+            self.hits += 1
+            return distance
+
+    def set(self, zip1, zip2, distance):
+        key = self._key(zip1, zip2)
+        with self._lock:
+            self._distances.pop(key, None)
+            self._distances[key] = distance
+            if len(self._distances) > self.maxsize:
+                self._distances.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._distances.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """ Return a dictionary of the cache's statistics."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._distances),
+            'maxsize': self.maxsize,
+        }
+
+DISTANCE_CACHE = DistanceCache()
 
 def zip_to_zip_miles(zip1, zip2):
+    """
+    Distance between two zips. Results are kept in ``DISTANCE_CACHE``, so
+    asking for the same pair (in either order) again is a dictionary lookup.
+
+        >>> int(zip_to_zip_miles("21211", "23233"))
+        129
+    """
+    distance = DISTANCE_CACHE.get(zip1, zip2)
+    if distance is not None:
+        return distance
     try:
-        zip1 = ZIPS[zip1]
+        point1 = ZIPS.point(zip1)
     except KeyError:
         raise ValueError(zip1)
     try:
-        zip2 = ZIPS[zip2]
+        point2 = ZIPS.point(zip2)
     except KeyError:
         raise ValueError(zip2)
-    return distance_miles(Point(*zip1), Point(*zip2))
+    distance = distance_miles(point1, point2)
+    DISTANCE_CACHE.set(zip1, zip2, distance)
+    return distance
 
 def distance_to_zip_miles(point, zip):
     """Distance between a point and a zip
 
-    Distance from Nashville International Airport (BNA) in Nashville to Los 
+    Distance from Nashville International Airport (BNA) in Nashville to Los
     Angeles International Airport (LAX) in Los Angeles:
 
         >>> lax = Point.from_degrees(33.94, -118.40)
@@ -59,10 +465,134 @@ def distance_to_zip_miles(point, zip):
         1.29...
     """
     try:
-        zip = ZIPS[zip]
+        zip = ZIPS.point(zip)
     except KeyError:
         raise ValueError(zip)
-    return distance_miles(point, Point(*zip))
+    return distance_miles(point, zip)
 
 def valid_zip(zip):
     return zip in ZIPS
+
+def _to_point(zip_or_point):
+    if isinstance(zip_or_point, Point):
+        return zip_or_point
+    try:
+        return ZIPS.point(zip_or_point)
+    except KeyError:
+        raise ValueError(zip_or_point)
+
+def zips_within_radius(zip_or_point, miles):
+    """
+    Return a list of ``(zip, distance in miles)`` tuples for all zips within
+    ``miles`` of the given zip code or ``Point``, nearest first. A zip code
+    is included in its own results.
+
+        >>> [zip for zip, miles in zips_within_radius("37217", 4)]
+        ['37217', '37011', '37013', '37211']
+    """
+    return get_index().within(_to_point(zip_or_point), miles)
+
+def nearest_zips(zip_or_point, n):
+    """
+    Return a list of ``(zip, distance in miles)`` tuples for the ``n`` zips
+    nearest the given zip code or ``Point``, nearest first.
+
+    Nearest zips to Nashville International Airport (BNA):
+
+        >>> bna = Point.from_degrees(36.12, -86.67)
+        >>> [zip for zip, miles in nearest_zips(bna, 3)]
+        ['37217', '37214', '37011']
+    """
+    return get_index().nearest(_to_point(zip_or_point), n)
+
+
+class DistanceMatrix(object):
+    """
+    A dense block of distances in miles between each of the ``rows`` zips
+    and each of the ``columns`` zips, which can be saved to disk and loaded
+    again later.
+    """
+
+    def __init__(self, rows, columns, distances):
+        self.rows = list(rows)
+        self.columns = list(columns)
+        if len(distances) != len(self.rows) * len(self.columns):
+            raise ValueError(
+                "Expected %d distances, got %d." % (
+                    len(self.rows) * len(self.columns), len(distances)
+                )
+            )
+        self.distances = distances
+        self._row_index = dict((zip, i) for i, zip in enumerate(self.rows))
+        self._column_index = dict(
+            (zip, i) for i, zip in enumerate(self.columns)
+        )
+
+    def __getitem__(self, key):
+        row, column = key
+        try:
+            i, j = self._row_index[row], self._column_index[column]
+        except KeyError:
+            # The matrix may hold the pair the other way around.
+            try:
+                i, j = self._row_index[column], self._column_index[row]
+            except KeyError:
+                raise KeyError(key)
+        return self.distances[i * len(self.columns) + j]
+
+    def get(self, zip1, zip2, default=None):
+        try:
+            return self[zip1, zip2]
+        except KeyError:
+            return default
+
+    def row(self, zip):
+        """ Return the distances from ``zip`` to each of the columns."""
+        start = self._row_index[zip] * len(self.columns)
+        return self.distances[start:start + len(self.columns)]
+
+    def save(self, path):
+        dest = open(path, 'wb')
+        try:
+            cPickle.dump({
+                'rows': self.rows,
+                'columns': self.columns,
+                'distances': self.distances.tostring(),
+            }, dest, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            dest.close()
+
+    @classmethod
+    def load(cls, path):
+        source = open(path, 'rb')
+        try:
+            data = cPickle.load(source)
+        finally:
+            source.close()
+        distances = array('d')
+        distances.fromstring(data['distances'])
+        return cls(data['rows'], data['columns'], distances)
+
+def distance_matrix(zips_a, zips_b):
+    """
+    Compute the distances in miles between every zip in ``zips_a`` and every
+    zip in ``zips_b`` as a ``DistanceMatrix``, one batch per row.
+
+        >>> matrix = distance_matrix(["37217", "21211"], ["23233", "37217"])
+        >>> int(matrix["21211", "23233"]), int(matrix["37217", "37217"])
+        (129, 0)
+    """
+    def to_points(zips):
+        points = []
+        for zip in zips:
+            try:
+                points.append(ZIPS.point(zip))
+            except KeyError:
+                raise ValueError(zip)
+        return points
+    zips_a, zips_b = list(zips_a), list(zips_b)
+    columns = to_points(zips_b)
+    distances = array('d')
+    for origin in to_points(zips_a):
+        distances.extend(distances_miles(origin, columns))
+    return DistanceMatrix(zips_a, zips_b, distances)
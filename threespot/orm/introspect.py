@@ -5,12 +5,62 @@ from operator import or_
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models import Q
+from django.db.models.loading import cache as app_cache
+from django.db.models.signals import class_prepared
 
 
 """
 This module provides helper functions for finding our more information about a specific model or object.
 """
 
+# The reverse-relation index: which fields of which models relate to a model,
+# and which models have generic relations. It's built on first use, once all
+# the models are loaded, and thrown away whenever another model is prepared.
+_relation_index = None
+
+def _build_relation_index():
+    index = {
+        # Maps a model to (referencing model, field, is M2M) tuples, in the
+        # order of ``models.get_models()``.
+        'fields': {},
+        # (model, [(content type lookup, object id field)]) tuples for models
+        # with generic foreign keys.
+        'generic': []
+    }
+    for model in models.get_models():
+        for field in model._meta.fields:
+            if field.rel:
+                index['fields'].setdefault(field.rel.to, []).append(
+                    (model, field, False)
+                )
+        for field in model._meta.many_to_many:
+            if field.rel:
+                index['fields'].setdefault(field.rel.to, []).append(
+                    (model, field, True)
+                )
+        if len(model._meta.virtual_fields) > 0:
+            index['generic'].append((model, [
+                (f.ct_field + "__pk", f.fk_field) \
+                    for f in model._meta.virtual_fields
+            ]))
+    return index
+
+def _get_relation_index():
+    global _relation_index
+    if _relation_index is not None:
+        return _relation_index
+    index = _build_relation_index()
+    # Don't keep an index built while the models are still being loaded.
+    if app_cache.app_cache_ready():
+        _relation_index = index
+    return index
+
+def _clear_relation_index(**kwargs):
+    global _relation_index
+    _relation_index = None
+
+class_prepared.connect(_clear_relation_index)
+
 
 def get_referencing_models(my_model, field_instance=None):
     """
@@ -33,24 +83,28 @@ def get_referencing_models(my_model, field_instance=None):
 
     """
     model_data_list = []
-    for model in models.get_models():
-        model_data = {
-            'model': model,
-            'field_names': [],
-            'm2m_field_names': []
-        }
-        if not (field_instance == models.ManyToManyField):
-            for field in model._meta.fields:
-                if not field_instance or isinstance(field, field_instance):
-                    if field.rel and field.rel.to == my_model:
-                        model_data['field_names'].append(field.name)
-        if not field_instance or field_instance == models.ManyToManyField:
-            for field in model._meta.many_to_many:
-                if field.rel and field.rel.to == my_model:
-                    model_data['m2m_field_names'].append(field.name)
-        if len(model_data['field_names']) > 0 \
-            or len(model_data['m2m_field_names']) > 0:
+    model_data_by_model = {}
+    relations = _get_relation_index()['fields'].get(my_model, [])
+    for model, field, is_m2m in relations:
+        if is_m2m:
+            if field_instance and field_instance != models.ManyToManyField:
+                continue
+            key = 'm2m_field_names'
+        else:
+            if field_instance == models.ManyToManyField:
+                continue
+            if field_instance and not isinstance(field, field_instance):
+                continue
+            key = 'field_names'
+        model_data = model_data_by_model.get(model)
+        if model_data is None:
+            model_data = model_data_by_model[model] = {
+                'model': model,
+                'field_names': [],
+                'm2m_field_names': []
+            }
             model_data_list.append(model_data)
+        model_data[key].append(field.name)
     return model_data_list
 
 # A shortcut function to return all models that have a
@@ -74,12 +128,24 @@ get_referencing_fk_models = partial(
     field_instance=models.ForeignKey
 )
 
+def get_generic_referencing_models():
+    """
+    This function returns a list of all models which could have a generic
+    relation to other models, as ``(model, field_lookups)`` tuples, where
+    ``field_lookups`` is a list of ``(content type lookup, object id field
+    name)`` pairs, e.g. ``('content_type__pk', 'object_id')``, one per
+    generic foreign key.
+    """
+    return list(_get_relation_index()['generic'])
+
 _default_queryset = lambda model: model.objects.all()
 
-def get_generic_referencing_objects(my_object, get_queryset=_default_queryset):
+def get_generic_referencing_querysets(my_object, \
+    get_queryset=_default_queryset):
     """
-    This function returns a list of all objects which have some sort of generic
-    relationship to the given ``my_object`` object. One optional argument:
+    This function returns a list of lazy querysets, one per model, of the
+    objects which have some sort of generic relationship to the given
+    ``my_object`` object. One optional argument:
 
         :get_queryset: A function which returns a queryset of related model
          objects. By default, Model.objects.all() is used.
@@ -90,13 +156,7 @@ def get_generic_referencing_objects(my_object, get_queryset=_default_queryset):
     ctype_pk = ContentType.objects.get_for_model(my_model).pk
     # Any model which has virtual fields could have Generic FK references to
     # the given model.
-    for model in (m for m in models.get_models() \
-        if len(m._meta.virtual_fields) > 0):
-        virtual_field_properties = []
-        for field in model._meta.virtual_fields:
-            virtual_field_properties.append(
-                (field.ct_field + "__pk", field.fk_field,)
-            )
+    for model, virtual_field_properties in _get_relation_index()['generic']:
         fk_filters = [Q(**{fk: my_object.pk}) for _, fk in virtual_field_properties]
         ctype_filters = [Q(**{ct: ctype_pk}) for ct, _ in virtual_field_properties]
         querysets.append(
@@ -104,43 +164,282 @@ def get_generic_referencing_objects(my_object, get_queryset=_default_queryset):
                 reduce(or_, ctype_filters),
                 reduce(or_, fk_filters)]
         ))
-    # ... then chain querysets together.
-    return list(chain(*querysets))
+    return querysets
 
-def get_referencing_objects(my_object, get_queryset=_default_queryset):
+def get_generic_referencing_objects(my_object, get_queryset=_default_queryset):
     """
-    This function returns a list of all objects which have some sort of
+    This function returns a list of all objects which have some sort of generic
     relationship to the given ``my_object`` object. One optional argument:
 
+        :get_queryset: A function which returns a queryset of related model
+         objects. By default, Model.objects.all() is used.
+
+    """
+    return list(chain(*get_generic_referencing_querysets(
+        my_object, get_queryset=get_queryset
+    )))
+
+def get_referencing_querysets(my_object, get_queryset=_default_queryset):
+    """
+    This function returns a list of lazy querysets, one per model, of the
+    objects which have some sort of relationship to the given ``my_object``
+    object. One optional argument:
+
         :get_queryset: A function which returns a queryset of the related model
          objects. By default, Model.objects.all() is used.
 
     """
     querysets = []
     my_model = my_object.__class__
-    # For each related model, filter based on FK rel to ``my_model``...
+    # For each related model, filter based on FK rel to ``my_model``.
     for model_data in get_referencing_models(my_model):
         queryset = get_queryset(model_data['model'])
         fields = model_data['field_names'] + model_data['m2m_field_names']
         filter_kwarg_names = ("%s__pk" % f for f in  fields)
         q_obj_list = (Q(**{kw: my_object.pk}) for kw in filter_kwarg_names)
         querysets.append(queryset.filter(reduce(or_, q_obj_list)))
-    # ... then chain querysets together.
-    return list(chain(*querysets))
+    return querysets
+
+def get_referencing_objects(my_object, get_queryset=_default_queryset):
+    """
+    This function returns a list of all objects which have some sort of
+    relationship to the given ``my_object`` object. One optional argument:
+
+        :get_queryset: A function which returns a queryset of the related model
+         objects. By default, Model.objects.all() is used.
+
+    """
+    return list(chain(*get_referencing_querysets(
+        my_object, get_queryset=get_queryset
+    )))
+
+def count_referencing_objects(my_object, get_queryset=_default_queryset,\
+    include_generic=True):
+    """
+    This function returns the number of objects which have some sort of
+    relationship to the given ``my_object`` object, running one COUNT query
+    per referencing model. Optional arguments:
+
+        :get_queryset: A function which returns a queryset of the related model
+         objects. By default, Model.objects.all() is used.
+
+        :include_generic: Whether to count generic references too. True by
+         default.
+
+    """
+    querysets = get_referencing_querysets(my_object, get_queryset)
+    if include_generic:
+        querysets += get_generic_referencing_querysets(my_object, get_queryset)
+    return sum(qs.count() for qs in querysets)
+
+def preview_referencing_objects(my_object, limit=10, fields=None,\
+    get_queryset=_default_queryset, include_generic=True):
+    """
+    This function returns a preview of the objects which have some sort of
+    relationship to the given ``my_object`` object, fetching at most ``limit``
+    objects per referencing model. Optional arguments:
+
+        :limit: The number of objects to fetch per model.
+
+        :fields: If given, only these fields of the objects are loaded (using
+         ``only()``).
+
+        :get_queryset: A function which returns a queryset of the related model
+         objects. By default, Model.objects.all() is used.
+
+        :include_generic: Whether to include generic references. True by
+         default.
+
+    This function returns a list of dictionaries, one per model with any
+    references:
+
+        {
+            'model': <The referencing model>,
+            'objects': [<Up to ``limit`` referencing objects>],
+            'has_more': <True if there are more than ``limit`` of them>
+        }
+
+    """
+    querysets = get_referencing_querysets(my_object, get_queryset)
+    if include_generic:
+        querysets += get_generic_referencing_querysets(my_object, get_queryset)
+    preview = []
+    for queryset in querysets:
+        if fields:
+            queryset = queryset.only(*fields)
+        # Fetch one more than we show to find out if there are more.
+        objects = list(queryset[:limit + 1])
+        if objects:
+            preview.append({
+                'model': queryset.model,
+                'objects': objects[:limit],
+                'has_more': len(objects) > limit
+            })
+    return preview
+
+def _add_reference(references, seen, target_pk, obj):
+    # Record ``obj`` as referencing ``target_pk``, once.
+    key = (target_pk, obj.__class__, obj.pk)
+    if key not in seen:
+        seen.add(key)
+        references[target_pk].append(obj)
+
+def get_referencing_objects_bulk(objects, get_queryset=_default_queryset):
+    """
+    This function finds the objects which have some sort of relationship to
+    any of the given ``objects``, which must all be of the same model, with
+    one ``__in`` query per referencing model and relation (plus one query of
+    the intermediary table for each M2M relation). One optional argument:
+
+        :get_queryset: A function which returns a queryset of the related model
+         objects. By default, Model.objects.all() is used.
+
+    This function returns a dictionary mapping the primary key of each of the
+    given ``objects`` to a list of the objects referencing it.
+    """
+    objects = list(objects)
+    references = dict((obj.pk, []) for obj in objects)
+    if not objects:
+        return references
+    seen = set()
+    my_model = objects[0].__class__
+    relations = _get_relation_index()['fields'].get(my_model, [])
+    for model, field, is_m2m in relations:
+        if is_m2m:
+            # Look up the pairs in the intermediary table, then fetch the
+            # referencing objects in one go.
+            source_name = field.m2m_field_name()
+            target_name = field.m2m_reverse_field_name()
+            pairs = field.rel.through._default_manager.filter(**{
+                target_name + '__in': references.keys()
+            }).values_list(source_name, target_name)
+            targets_by_source = {}
+            for source_pk, target_pk in pairs:
+                targets_by_source.setdefault(source_pk, []).append(target_pk)
+            if not targets_by_source:
+                continue
+            queryset = get_queryset(model).filter(
+                pk__in=targets_by_source.keys()
+            )
+            for obj in queryset:
+                for target_pk in targets_by_source[obj.pk]:
+                    _add_reference(references, seen, target_pk, obj)
+        else:
+            # The FK may point at a field other than the primary key.
+            related_attname = field.rel.get_related_field().attname
+            pks_by_value = dict(
+                (getattr(obj, related_attname), obj.pk) for obj in objects
+            )
+            queryset = get_queryset(model).filter(**{
+                field.name + '__in': pks_by_value.keys()
+            })
+            for obj in queryset:
+                target_pk = pks_by_value[getattr(obj, field.attname)]
+                _add_reference(references, seen, target_pk, obj)
+    return references
+
+def get_generic_referencing_objects_bulk(objects, \
+    get_queryset=_default_queryset):
+    """
+    This function finds the objects which have some sort of generic
+    relationship to any of the given ``objects``, which must all be of the
+    same model, with one query per referencing model and generic relation.
+    One optional argument:
+
+        :get_queryset: A function which returns a queryset of related model
+         objects. By default, Model.objects.all() is used.
+
+    This function returns a dictionary mapping the primary key of each of the
+    given ``objects`` to a list of the objects referencing it.
+    """
+    objects = list(objects)
+    references = dict((obj.pk, []) for obj in objects)
+    if not objects:
+        return references
+    seen = set()
+    ctype_pk = ContentType.objects.get_for_model(objects[0].__class__).pk
+    # Object ids are often stored as text or with another type than the
+    # primary key, so match them by their unicode values.
+    pks_by_value = dict((unicode(pk), pk) for pk in references)
+    for model, virtual_field_properties in _get_relation_index()['generic']:
+        for ct, fk in virtual_field_properties:
+            queryset = get_queryset(model).filter(**{
+                ct: ctype_pk,
+                fk + '__in': references.keys()
+            })
+            for obj in queryset:
+                target_pk = pks_by_value.get(unicode(getattr(obj, fk)))
+                if target_pk is not None:
+                    _add_reference(references, seen, target_pk, obj)
+    return references
 
 def lookup_referencing_object_relationships(my_obj, referencing_obj):
     """
     Return a list of field names on the given ``referencing_object`` which
     reference ``my_object``.
+
+    FKs are compared by their raw values, without fetching the related
+    object; each M2M relation costs one ``exists()`` query.
     """
     for data in get_referencing_models(my_obj.__class__):
         fields = []
         if data['model'] == referencing_obj.__class__:
             for field in data['field_names']:
-                if getattr(referencing_obj, field).pk == my_obj.pk:
+                model_field = referencing_obj._meta.get_field(field)
+                if _get_fk_value(referencing_obj, model_field) == \
+                    _get_related_value(my_obj, model_field):
                     fields.append(field)
             for field in data['m2m_field_names']:
-                pks = [o.pk for o in getattr(referencing_obj, field).all()]
-                if my_obj.pk in pks:
+                if getattr(referencing_obj, field).filter(
+                    pk=my_obj.pk).exists():
                     fields.append(field)
-            return fields
\ No newline at end of file
+            return fields
+
+def lookup_referencing_object_relationships_bulk(my_obj, referencing_objs):
+    """
+    Return a list of ``(referencing_object, field names)`` pairs giving the
+    field names on each of the given ``referencing_objs`` which reference
+    ``my_obj``.
+
+    FKs are compared by their raw values, and each M2M relation costs one
+    query of its intermediary table for all the referencing objects together.
+    """
+    referencing_objs = list(referencing_objs)
+    field_names = [[] for _ in referencing_objs]
+    positions_by_model = {}
+    for i, obj in enumerate(referencing_objs):
+        positions_by_model.setdefault(obj.__class__, []).append(i)
+    for data in get_referencing_models(my_obj.__class__):
+        positions = positions_by_model.get(data['model'])
+        if not positions:
+            continue
+        for field in data['field_names']:
+            model_field = data['model']._meta.get_field(field)
+            value = _get_related_value(my_obj, model_field)
+            for i in positions:
+                if _get_fk_value(referencing_objs[i], model_field) == value:
+                    field_names[i].append(field)
+        for field in data['m2m_field_names']:
+            model_field = data['model']._meta.get_field(field)
+            source_name = model_field.m2m_field_name()
+            target_name = model_field.m2m_reverse_field_name()
+            referencing_pks = set(
+                model_field.rel.through._default_manager.filter(**{
+                    target_name: my_obj.pk,
+                    source_name + '__in': [
+                        referencing_objs[i].pk for i in positions
+                    ]
+                }).values_list(source_name, flat=True)
+            )
+            for i in positions:
+                if referencing_objs[i].pk in referencing_pks:
+                    field_names[i].append(field)
+    return zip(referencing_objs, field_names)
+
+def _get_fk_value(obj, field):
+    # The raw value of a FK, without fetching the related object.
+    return getattr(obj, field.attname)
+
+def _get_related_value(obj, field):
+    # The value of ``obj`` a FK ``field`` pointing at it would hold.
+    return getattr(obj, field.rel.get_related_field().attname)
@@ -37,6 +37,9 @@ class Post(models.Model):
 """
 
 
+# Generated manager classes, keyed by the arguments of ``manager_from``.
+_manager_classes = {}
+
 def manager_from(*mixins, **kwds):
     '''
     Returns a Manager instance with extra methods, also available and
@@ -51,7 +54,19 @@ def manager_from(*mixins, **kwds):
 
     :keyword manager_cls: The base manager class to extend from
         (``django.db.models.manager.Manager`` by default).
+
+    The generated classes are shared by every call with the same arguments.
     '''
+    key = mixins + tuple(sorted(kwds.iteritems()))
+    try:
+        new_manager_cls = _manager_classes[key]
+    except KeyError:
+        new_manager_cls = _manager_classes[key] = _create_manager_cls(
+            mixins, kwds
+        )
+    return new_manager_cls()
+
+def _create_manager_cls(mixins, kwds):
     # collect separately the mixin classes and methods
     bases = [kwds.get('queryset_cls', QuerySet)]
     methods = {}
@@ -71,15 +86,21 @@ def manager_from(*mixins, **kwds):
     new_manager_cls = type('Manager_%d' % id, tuple(bases), methods)
     # and finally override new manager's get_query_set
     super_get_query_set = manager_cls.get_query_set
+    # The queryset classes the super manager's get_query_set has returned and
+    # that have been checked for compatibility with the new Queryset class.
+    compatible_classes = set([new_queryset_cls])
     def get_query_set(self):
         # first honor the super manager's get_query_set
         qs = super_get_query_set(self)
         # and then try to bless the returned queryset by reassigning it to the
         # newly created Queryset class, though this may not be feasible
-        if not issubclass(new_queryset_cls, qs.__class__):
-            raise TypeError('QuerySet subclass conflict: cannot determine a '
-                            'unique class for queryset instance')
+        qs_cls = qs.__class__
+        if qs_cls not in compatible_classes:
+            if not issubclass(new_queryset_cls, qs_cls):
+                raise TypeError('QuerySet subclass conflict: cannot determine '
+                                'a unique class for queryset instance')
+            compatible_classes.add(qs_cls)
         qs.__class__ = new_queryset_cls
         return qs
     new_manager_cls.get_query_set = get_query_set
-    return new_manager_cls()
\ No newline at end of file
+    return new_manager_cls
@@ -1,29 +1,27 @@
-from copy import deepcopy
-from itertools import chain
-
 from django import template
 from django.contrib import admin
 from django.contrib.admin import helpers
 from django.contrib.admin.models import LogEntry
 from django.contrib.admin.options import csrf_protect_m
 from django.contrib.admin.util import unquote
-from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.db import models, transaction
-from django.db.models.fields.related import RelatedField
 from django.http import Http404, HttpResponseBadRequest, HttpResponseRedirect
-from django.shortcuts import get_object_or_404, render_to_response
+from django.shortcuts import render_to_response
 from django.utils.encoding import force_unicode
 from django.utils.functional import update_wrapper
 from django.utils.html import escape
 from django.utils.translation import ugettext_lazy as _
 
-from threespot.orm.introspect import get_referencing_objects, \
-    get_generic_referencing_objects, lookup_referencing_object_relationships
-from threespot.workflow.app_settings import UNPUBLISHED_STATES, \
-    PUBLISHED_STATE, USE_DJANGO_REVERSION
+from threespot.workflow.app_settings import PUBLISHED_STATE, \
+    USE_DJANGO_REVERSION
+from threespot.workflow.drafts import copy_item, merge_item
+from threespot.workflow.jobs import enqueue_merge, get_pending_job
+from threespot.workflow.managers import WorkflowQuerySet
+from threespot.workflow.models import MergeJob
+from threespot.workflow.references import get_reference_preview
 
 
 if USE_DJANGO_REVERSION:
@@ -55,6 +53,8 @@ class WorkflowAdmin(AdminParentClass):
     copy_form_template = "workflow/admin/copy_confirmation.html"
     draft_copy_allowed = True
     merge_form_template = "workflow/admin/merge_confirmation.html"
+    merge_in_background = False
+    merge_job_template = "workflow/admin/merge_job_status.html"
     exclude = ['copy_of']
     slug_field = 'slug'
     slug = False
@@ -85,6 +85,9 @@ class WorkflowAdmin(AdminParentClass):
             url(r'^(.+)/merge/$', wrap(self.merge_view),
                 name = '%s_%s_merge' % info
             ),
+            url(r'^merge-jobs/(\d+)/$', wrap(self.merge_job_view),
+                name = '%s_%s_merge_job' % info
+            ),
         )
         return workflow_urls + urls
 
@@ -151,24 +154,27 @@ class WorkflowAdmin(AdminParentClass):
                 selected_ids = request.POST.getlist(
                     helpers.ACTION_CHECKBOX_NAME
                 )
-                for obj_id in selected_ids:
-                    obj = get_object_or_404(self.model, id=obj_id)
-                    if obj.is_published():
-                        change_list_url = reverse("admin:%s_%s_changelist" % (
-                            obj._meta.app_label, obj._meta.module_name
-                        ))
-                        if len(selected_ids) > 1:
-                            msg = (
-                                "You do not have permission to delete these "
-                                " items: at least one is already published."
-                            )
-                        else:
-                            msg = (
-                                "You do not have permission to delete this "
-                                " item: it is already published."
-                            )
-                        self.message_user(request, msg)
-                        return HttpResponseRedirect(change_list_url)
+                # Check the whole selection with one query.
+                selected = WorkflowQuerySet(self.model).filter(
+                    pk__in=selected_ids
+                )
+                if selected.published_subset().exists():
+                    opts = self.model._meta
+                    change_list_url = reverse("admin:%s_%s_changelist" % (
+                        opts.app_label, opts.module_name
+                    ))
+                    if len(selected_ids) > 1:
+                        msg = (
+                            "You do not have permission to delete these "
+                            " items: at least one is already published."
+                        )
+                    else:
+                        msg = (
+                            "You do not have permission to delete this "
+                            " item: it is already published."
+                        )
+                    self.message_user(request, msg)
+                    return HttpResponseRedirect(change_list_url)
         return super(WorkflowAdmin, self).changelist_view(request, 
             extra_context=extra_context
         )
@@ -205,7 +211,7 @@ class WorkflowAdmin(AdminParentClass):
             )
 
         obj = self.get_object(request, unquote(object_id))
-        object_refs = None
+        object_refs = reference_preview = None
 
         # For our purposes, permission to copy is equivalent to 
         # has_add_permisison.
@@ -277,17 +283,15 @@ class WorkflowAdmin(AdminParentClass):
             draft_already_exists = False
             title = _("Are you sure?")
             edit_copy_url = None
-            generic_refs = get_generic_referencing_objects(obj)
-            direct_refs = get_referencing_objects(obj)
-            object_refs = [(unicode(o), o._meta.verbose_name) for o in \
-                chain(direct_refs, generic_refs)
-            ]
+            reference_preview = get_reference_preview(obj)
+            object_refs = self._get_reference_list(reference_preview)
             
         context = {
             "title": title,
             "object_name": force_unicode(opts.verbose_name),
             "object": obj,
             "referencing_objects": object_refs,
+            "reference_preview": reference_preview,
             "opts": opts,
             "root_path": self.admin_site.root_path,
             "app_label": app_label,
@@ -340,18 +344,12 @@ class WorkflowAdmin(AdminParentClass):
                 'draft copy. There is nothing to merge it into.'
             ) % force_unicode(opts.verbose_name))
 
-        # Populate deleted_objects, a data structure of all related objects
-        # that will also be deleted when this copy is deleted.
-        generic_refs = get_generic_referencing_objects(obj.copy_of)
-        direct_refs = get_referencing_objects(obj.copy_of)
-        direct_refs = filter(lambda o: obj != o, direct_refs)
-        object_refs = [(unicode(o), o._meta.verbose_name) for o in \
-            chain(direct_refs, generic_refs)
-        ]
         perms_needed = False
         if request.POST: # The user has already confirmed the merge.
             if perms_needed:
                 raise PermissionDenied            
+            if self.merge_in_background:
+                return self._enqueue_merge(request, obj)
             original = obj.copy_of
             original_pk = original.pk
             self._merge_item(original, obj)
@@ -377,12 +375,18 @@ class WorkflowAdmin(AdminParentClass):
 
             return HttpResponseRedirect("../../")
 
+        # Summarize the objects which will be repointed at this copy (the
+        # copy itself references the original).
+        reference_preview = get_reference_preview(obj.copy_of, exclude=obj)
         context = {
             "title": _("Are you sure?"),
             "object_name": force_unicode(opts.verbose_name),
             "object": obj,
             "escaped_original": force_unicode(obj.copy_of), 
-            "referencing_objects": object_refs,
+            "referencing_objects": self._get_reference_list(
+                reference_preview
+            ),
+            "reference_preview": reference_preview,
             "opts": opts,
             "root_path": self.admin_site.root_path,
             "app_label": app_label,
@@ -396,87 +400,115 @@ class WorkflowAdmin(AdminParentClass):
             context_instance=context_instance
         )
 
+    def _get_reference_list(self, reference_preview):
+        """
+        Flatten a reference preview into ``(title, verbose name)`` pairs, the
+        ``referencing_objects`` of templates predating ``reference_preview``.
+        """
+        return [(title, group['verbose_name']) \
+            for group in reference_preview for title in group['objects']
+        ]
+
+    def _enqueue_merge(self, request, draft_copy):
+        """
+        Queue the merge of ``draft_copy`` and redirect to its status page.
+        """
+        opts = self.model._meta
+        job = get_pending_job(draft_copy)
+        if job is None:
+            job = enqueue_merge(draft_copy.copy_of, draft_copy,
+                slug_field=self.slug and self.slug_field,
+                user=request.user
+            )
+            self.message_user(
+                request,
+                _('The merge of the %(name)s "%(obj)s" has been queued.') % {
+                    'name': force_unicode(opts.verbose_name),
+                    'obj': force_unicode(draft_copy)
+                }
+            )
+        else:
+            self.message_user(
+                request,
+                _('This %(name)s is already being merged.') % {
+                    'name': force_unicode(opts.verbose_name)
+                }
+            )
+        url = reverse(
+            "admin:%s_%s_merge_job" % (opts.app_label, opts.module_name),
+            args=(job.pk,)
+        )
+        return HttpResponseRedirect(url)
+
+    def merge_job_view(self, request, job_id, extra_context=None):
+        """
+        Show the progress of a background merge. The page refreshes itself
+        until the merge has finished.
+        """
+        opts = self.model._meta
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            job = MergeJob.objects.get(
+                pk=job_id,
+                content_type=ContentType.objects.get_for_model(self.model)
+            )
+        except MergeJob.DoesNotExist:
+            raise Http404(_('Merge job %r does not exist.') % escape(job_id))
+        try:
+            obj = self.model._default_manager.get(pk=job.draft_id)
+        except self.model.DoesNotExist:
+            obj = None
+        context = {
+            "title": _("Merge status"),
+            "object_name": force_unicode(opts.verbose_name),
+            "object": obj,
+            "job": job,
+            "opts": opts,
+            "root_path": self.admin_site.root_path,
+            "app_label": opts.app_label,
+        }
+        context.update(extra_context or {})
+        context_instance = template.RequestContext(
+            request, 
+            current_app=self.admin_site.name
+        )
+        return render_to_response(self.merge_job_template, context, 
+            context_instance=context_instance
+        )
+
     def _copy_item(self, item):
         """ Create a copy of a published item to edit."""
         if not item.is_published:
             return None
-        new_item = deepcopy(item)
-        new_item.id = None
-        new_item.status = UNPUBLISHED_STATES[0][0]
-        new_item.copy_of = item
-        if self.slug:
-            slug = getattr(new_item, self.slug_field)
-            slug += "-draft-copy"
-            setattr(new_item, self.slug_field, slug)
-        new_item.save()
-        fk_rels = [f.name for f in self.model._meta.fields \
-            if issubclass(f.__class__, RelatedField) and f.name != 'copy_of'
-        ]
-        for field in fk_rels:
-            setattr(new_item, field, getattr(item, field))
-        m2m_rels = [f.name for f, _ in self.model._meta.get_m2m_with_model()]
-        for field in m2m_rels:
-            # If there is a custom "through" model, punt on trying to copy 
-            # things over.
-            model_field = new_item._meta.get_field_by_name(field)[0]
-            if model_field.rel.through._meta.auto_created:
-                setattr(new_item, field, getattr(item, field).all())
-        new_item.save()
-        return new_item
+        return copy_item(item, slug_field=self.slug and self.slug_field)
         
     def _merge_item(self, original, draft_copy):
         """ Delete original, clean up and publish copy."""
-        # Handle FK and M2M references.
-        refs = filter(
-            lambda obj: obj != draft_copy,
-            get_referencing_objects(original)
+        return merge_item(original, draft_copy,
+            slug_field=self.slug and self.slug_field
         )
-        for ref in refs:
-            field_names = lookup_referencing_object_relationships(original, ref)
-            for field_name in field_names:
-                fld_class = ref._meta.get_field(field_name).__class__
-                if issubclass(fld_class, models.fields.related.ManyToManyField):
-                    getattr(ref, field_name).remove(original)
-                    getattr(ref, field_name).add(draft_copy)
-                else:
-                    setattr(ref, field_name, draft_copy)
-                    ref.save()
-        # Handle generic references.
-        for ref in get_generic_referencing_objects(original):
-            generic_fk_field = [f for f in ref._meta.virtual_fields \
-                if isinstance(f, generic.GenericForeignKey)
-            ][0].name
-            setattr(ref, generic_fk_field, draft_copy)
-            ref.save()
-        # Overwrite the old object.
-        if self.slug:
-            setattr(original, self.slug_field, original.slug + "-merge")
-        original.save()
-        if self.slug:
-            import re
-            slug = re.sub(
-                "-draft-copy$", "", getattr(draft_copy, self.slug_field)
-            )
-            setattr(draft_copy, self.slug_field, slug)
-        draft_copy.copy_of = None
-        draft_copy.save()
-        original.delete()
-        draft_copy.publish()
-        return draft_copy
+
+    def _get_workflow_queryset(self, queryset):
+        # Action querysets come from the default manager, which needn't be a
+        # ``WorkflowManager``.
+        if isinstance(queryset, WorkflowQuerySet):
+            return queryset
+        return queryset._clone(klass=WorkflowQuerySet)
 
     def publish_items(self, request, queryset):
         """ Admin action publishing the selected items."""
+        queryset = self._get_workflow_queryset(queryset)
         # We should exclude any draft copies: these can only be published 
-        # through merging.
-        original_length = len(queryset)
-        rows_updated = queryset.filter(copy_of__exact=None).update(
-            status=PUBLISHED_STATE
-        )
+        # through merging. ``publish`` returns the number of items it
+        # published, and sends the ``workflow_published`` signal, which also
+        # expires their caches.
+        rows_updated = queryset.filter(copy_of__exact=None).publish()
         if rows_updated == 1:
             message = "One item was successfully published."
         else:
             message = "%d items were successfully published." % rows_updated
-        if original_length != rows_updated:
+        if queryset.exclude(copy_of__exact=None).exists():
             message += (
                 " Any draft copies selected were not published; to publish "
                 " these, merge them into the original."
@@ -486,7 +518,7 @@ class WorkflowAdmin(AdminParentClass):
 
     def unpublish_items(self, request, queryset):
         """ Admin action publishing the selected items."""
-        rows_updated = queryset.update(status=UNPUBLISHED_STATES[0][0])
+        rows_updated = self._get_workflow_queryset(queryset).unpublish()
         if rows_updated == 1:
             message = "One item was successfully unpublished."
         else:
@@ -44,3 +44,63 @@ ENABLE_POSTDATED_PUBLISHING = workflow_settings_mgr.create(
     'ENABLE_POSTDATED_PUBLISHING',
     default=True
 )
+
+# With postdated publishing, "now" is rounded down to a multiple of this many
+# seconds (e.g. 60 to round down to the minute), so queries made within the
+# same period have the same parameters and can be cached. 0 disables rounding.
+PUBLISH_TIME_QUANTUM = workflow_settings_mgr.create('PUBLISH_TIME_QUANTUM',
+    default=1
+)
+
+# If True, the querysets returned by ``WorkflowManager.published()`` and
+# ``unpublished()`` are shared within a request, so they are evaluated at most
+# once per request.
+CACHE_PUBLISHED_QUERYSETS = workflow_settings_mgr.create(
+    'CACHE_PUBLISHED_QUERYSETS',
+    default=False
+)
+
+# If True, syncdb creates a composite (status, date) index, and where the
+# database supports it a partial index of the published rows, for each model
+# with postdated publishing. See ``threespot.workflow.indexes``.
+CREATE_STATUS_DATE_INDEXES = workflow_settings_mgr.create(
+    'CREATE_STATUS_DATE_INDEXES',
+    default=True
+)
+
+# The number of references a background merge job repoints per transaction.
+MERGE_CHUNK_SIZE = workflow_settings_mgr.create('MERGE_CHUNK_SIZE',
+    default=500
+)
+
+# The number of seconds after which a running background merge job which hasn't
+# recorded any progress is taken to have been abandoned, and is queued again.
+MERGE_JOB_TIMEOUT = workflow_settings_mgr.create('MERGE_JOB_TIMEOUT',
+    default=60 * 10
+)
+
+# If True, background merge jobs are run by a thread of the process which
+# queued them, rather than by the ``run_merge_jobs`` management command.
+MERGE_JOBS_IN_PROCESS = workflow_settings_mgr.create('MERGE_JOBS_IN_PROCESS',
+    default=False
+)
+
+# How long, in seconds, the summary of the objects referencing an object shown
+# on the copy and merge confirmation pages is cached. 0 disables the cache.
+REFERENCE_PREVIEW_TIMEOUT = workflow_settings_mgr.create(
+    'REFERENCE_PREVIEW_TIMEOUT',
+    default=60 * 10
+)
+
+# The number of referencing objects listed per model on those pages.
+REFERENCE_PREVIEW_LIMIT = workflow_settings_mgr.create(
+    'REFERENCE_PREVIEW_LIMIT',
+    default=10
+)
+
+# The number of rows ``WorkflowQuerySet.publish()`` and ``unpublish()`` update
+# per statement.
+BULK_PUBLISH_CHUNK_SIZE = workflow_settings_mgr.create(
+    'BULK_PUBLISH_CHUNK_SIZE',
+    default=1000
+)
@@ -0,0 +1,235 @@
+import re
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+
+from threespot.orm.introspect import get_referencing_models, \
+    get_generic_referencing_models
+from threespot.workflow.app_settings import UNPUBLISHED_STATES
+from threespot.workflow.managers import clear_queryset_cache
+from threespot.workflow.references import expire_reference_previews
+
+"""
+Set-based draft copying and merging.
+
+Copying an item inserts the copy with one ``save()`` and each of its M2M
+relations with one bulk insert. Merging a draft copy over its original
+repoints every reference to the original with one ``UPDATE`` per relation
+(per generic foreign key, for generic relations) rather than saving each
+referencing object, so the number of queries doesn't grow with the number of
+references.
+
+References are found with each model's base manager, so rows hidden by a
+filtering default manager are repointed too, rather than deleted along with
+the original. Note that, as with ``QuerySet.update()``, no ``save`` or
+``m2m_changed`` signals are sent for the rewritten references.
+"""
+
+def _bulk_insert(through, source_name, target_name, rows):
+    # Insert (source pk, target pk) rows into an M2M intermediary table.
+    if not rows:
+        return
+    opts = through._meta
+    source_field = opts.get_field(source_name)
+    target_field = opts.get_field(target_name)
+    manager = through._base_manager
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create([through(**{
+            source_field.attname: source_pk,
+            target_field.attname: target_pk
+        }) for source_pk, target_pk in rows])
+    else:
+        using = router.db_for_write(through)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+            qn(opts.db_table), qn(source_field.column),
+            qn(target_field.column)
+        ), rows)
+        transaction.commit_unless_managed(using=using)
+    # No ``m2m_changed`` signal is sent for the rows.
+    expire_reference_previews(target_field.rel.to,
+        [target_pk for _, target_pk in rows]
+    )
+
+def copy_item(item, slug_field=None):
+    """
+    Create and return an unpublished draft copy of ``item``. If
+    ``slug_field`` is given, "-draft-copy" is appended to the copy's slug.
+    M2M relations with a custom intermediary model aren't copied.
+    """
+    model = item.__class__
+    opts = model._meta
+    values = dict(
+        (f.attname, getattr(item, f.attname)) for f in opts.fields \
+            if not f.primary_key
+    )
+    new_item = model(**values)
+    new_item.status = UNPUBLISHED_STATES[0][0]
+    new_item.copy_of = item
+    if slug_field:
+        setattr(new_item, slug_field,
+            getattr(new_item, slug_field) + "-draft-copy"
+        )
+    new_item.save()
+    for field, _ in opts.get_m2m_with_model():
+        through = field.rel.through
+        # If there is a custom "through" model, punt on trying to copy
+        # things over.
+        if not through._meta.auto_created:
+            continue
+        source_name = field.m2m_field_name()
+        target_name = field.m2m_reverse_field_name()
+        target_pks = through._base_manager.filter(**{
+            source_name: item.pk
+        }).values_list(target_name, flat=True)
+        rows = [(new_item.pk, pk) for pk in target_pks]
+        if field.rel.to == model and field.rel.symmetrical:
+            # Symmetrical relations are stored in both directions.
+            rows += [(pk, new_item.pk) for pk in target_pks]
+        _bulk_insert(through, source_name, target_name, rows)
+    return new_item
+
+def _update(queryset, values, chunk_size=None, progress=None):
+    # Update the rows of ``queryset``, in chunks of ``chunk_size`` rows if
+    # it's given, calling ``progress`` with the number of rows after each
+    # statement. Returns the number of rows updated.
+    if not chunk_size:
+        updated = queryset.update(**values)
+        if progress and updated:
+            progress(updated)
+        return updated
+    pks = list(queryset.values_list('pk', flat=True))
+    manager = queryset.model._base_manager
+    for i in range(0, len(pks), chunk_size):
+        chunk = pks[i:i + chunk_size]
+        manager.filter(pk__in=chunk).update(**values)
+        if progress:
+            progress(len(chunk))
+    return len(pks)
+
+def _get_local_field_names(model):
+    # The names of the fields stored in the table of ``model``. Proxies and
+    # multi-table subclasses are listed as referencing models too, but their
+    # inherited references are updated through the model which stores them.
+    if model._meta.proxy:
+        return set()
+    opts = model._meta
+    return set(f.name for f in opts.local_fields + opts.local_many_to_many)
+
+def _get_reference_updates(original, draft_copy):
+    # Yield ``(model, queryset, values)`` for each FK, O2O and generic
+    # relation: updating ``queryset`` with ``values`` points its references
+    # to ``original`` at ``draft_copy``.
+    for data in get_referencing_models(original.__class__):
+        model = data['model']
+        manager = model._base_manager
+        local_names = _get_local_field_names(model)
+        for field_name in data['field_names']:
+            if field_name not in local_names:
+                continue
+            queryset = manager.filter(**{field_name: original})
+            if model == draft_copy.__class__:
+                # The draft's own ``copy_of`` reference is dropped on merge.
+                queryset = queryset.exclude(pk=draft_copy.pk)
+            yield model, queryset, {field_name: draft_copy}
+    ctype_pk = ContentType.objects.get_for_model(original.__class__).pk
+    for model, field_lookups in get_generic_referencing_models():
+        local_names = _get_local_field_names(model)
+        for ct_lookup, fk_field in field_lookups:
+            if ct_lookup.split('__')[0] not in local_names:
+                continue
+            queryset = model._base_manager.filter(**{
+                ct_lookup: ctype_pk,
+                fk_field: original.pk
+            })
+            yield model, queryset, {fk_field: draft_copy.pk}
+
+def _get_m2m_fields(original):
+    # Yield the M2M fields relating to the model of ``original``.
+    for data in get_referencing_models(original.__class__):
+        local_names = _get_local_field_names(data['model'])
+        for field_name in data['m2m_field_names']:
+            if field_name in local_names:
+                yield data['model']._meta.get_field(field_name)
+
+def count_references(original, draft_copy):
+    """
+    Return the number of rows ``merge_item`` repoints (or deletes, for M2M
+    rows which would duplicate existing ones): the total of the counts it
+    passes to ``progress``.
+    """
+    count = 0
+    for model, queryset, values in _get_reference_updates(original,
+        draft_copy):
+        count += queryset.count()
+    for field in _get_m2m_fields(original):
+        count += field.rel.through._base_manager.filter(**{
+            field.m2m_reverse_field_name(): original.pk
+        }).count()
+    return count
+
+def _repoint_references(original, draft_copy, chunk_size=None,\
+    progress=None):
+    # Point every FK, O2O, M2M and generic reference to ``original`` at
+    # ``draft_copy``.
+    touched_models = set()
+    for model, queryset, values in _get_reference_updates(original,
+        draft_copy):
+        if _update(queryset, values, chunk_size, progress):
+            touched_models.add(model)
+    for field in _get_m2m_fields(original):
+        through = field.rel.through._base_manager
+        source_name = field.m2m_field_name()
+        target_name = field.m2m_reverse_field_name()
+        # Drop the rows which would duplicate existing ones, then move the
+        # rest over.
+        duplicate_pks = list(through.filter(**{
+            target_name: draft_copy.pk
+        }).values_list(source_name, flat=True))
+        if duplicate_pks:
+            duplicates = through.filter(**{
+                target_name: original.pk,
+                source_name + '__in': duplicate_pks
+            })
+            count = progress and duplicates.count()
+            duplicates.delete()
+            if count:
+                progress(count)
+        _update(through.filter(**{target_name: original.pk}),
+            {target_name: draft_copy.pk}, chunk_size, progress
+        )
+    for model in touched_models:
+        clear_queryset_cache(model)
+    expire_reference_previews(original.__class__,
+        [original.pk, draft_copy.pk]
+    )
+
+def merge_item(original, draft_copy, slug_field=None, chunk_size=None,\
+    progress=None):
+    """
+    Merge ``draft_copy`` over ``original``: repoint the references to the
+    original at the copy, delete the original and publish the copy. If
+    ``slug_field`` is given, the copy gets the original's slug back.
+
+    If ``chunk_size`` is given, references are repointed that many rows at a
+    time, and ``progress`` is called with the number of rows repointed after
+    each chunk (e.g. to commit the transaction; see
+    ``threespot.workflow.jobs``).
+    """
+    _repoint_references(original, draft_copy, chunk_size, progress)
+    # Overwrite the old object.
+    if slug_field:
+        setattr(original, slug_field, getattr(original, slug_field) + "-merge")
+    original.save()
+    if slug_field:
+        slug = re.sub(
+            "-draft-copy$", "", getattr(draft_copy, slug_field)
+        )
+        setattr(draft_copy, slug_field, slug)
+    draft_copy.copy_of = None
+    draft_copy.save()
+    original.delete()
+    draft_copy.publish()
+    return draft_copy
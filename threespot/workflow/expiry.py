@@ -0,0 +1,263 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models.loading import cache as app_cache
+from django.db.models.signals import pre_save, post_save, post_delete, \
+    class_prepared
+
+from threespot.cache.expire import expire_view_caches, \
+    invalidate_template_caches
+from threespot.cache.tags import bump_tags
+from threespot.workflow.app_settings import BULK_PUBLISH_CHUNK_SIZE, \
+    ENABLE_POSTDATED_PUBLISHING, PUBLISHED_STATE, PUBLISH_TIME_QUANTUM
+from threespot.workflow.signals import became_published, \
+    workflow_published, workflow_unpublished
+from threespot.workflow.utils import get_current_datetime, \
+    get_go_live_datetime
+
+"""
+Automatic expiry of the caches that show workflow objects.
+
+Register a ``CacheDependencies`` subclass for a workflow model to declare the
+views, template fragments and cache tags which depend on its objects::
+
+    from threespot.workflow import expiry
+
+    class ArticleCacheDependencies(expiry.CacheDependencies):
+        views = [('article_detail', ['slug']), ('article_list', [])]
+        fragments = [('article_teaser', ['pk'])]
+        tags = ['article:%(pk)s']
+
+    expiry.register(Article, ArticleCacheDependencies)
+
+Whenever an object that is, or was, published is saved or deleted, is
+published or unpublished in bulk (see ``WorkflowQuerySet.publish()``), or a
+postdated object goes live (see ``threespot.workflow.scheduler``), its caches
+are queued for expiry. The queue is flushed once the request has finished (so
+after ``TransactionMiddleware`` or ``commit_on_success`` has committed), or
+straight away outside of a managed transaction, expiring all the queued views,
+fragments and tags of each cache in a batch. When an object's view arguments
+or fragment variables change (e.g. its slug), the caches of both the old and
+the new values are expired.
+"""
+
+_registry = {}
+_local = threading.local()
+logger = logging.getLogger('threespot.workflow.expiry')
+
+
+class CacheDependencies(object):
+    """
+    Declares the caches that depend on the objects of a workflow model.
+
+    * ``views``: ``(view_name, attribute names)`` pairs; the values of the
+      attributes are the arguments of the view's URL.
+    * ``fragments``: ``(fragment_name, attribute names)`` pairs; the values of
+      the attributes are the variables the fragment was cached with.
+    * ``tags``: cache tags, formatted with the object's attributes and ``pk``.
+
+    Override ``get_views``, ``get_fragments`` or ``get_tags`` for anything
+    these can't express.
+    """
+    views = ()
+    fragments = ()
+    tags = ()
+    key_prefix = None
+    cache_alias = None
+
+    def _resolve(self, obj, attrs):
+        return [getattr(obj, attr) for attr in attrs]
+
+    def get_views(self, obj):
+        """ Return ``(view_name, args)`` pairs of the views showing ``obj``."""
+        return [(name, self._resolve(obj, attrs)) for name, attrs in self.views]
+
+    def get_fragments(self, obj):
+        """
+        Return ``(fragment_name, variables)`` pairs of the fragments showing
+        ``obj``.
+        """
+        return [
+            (name, self._resolve(obj, attrs)) for name, attrs in self.fragments
+        ]
+
+    def get_tags(self, obj):
+        """ Return the cache tags carried by the entries showing ``obj``."""
+        values = dict(obj.__dict__, pk=obj.pk)
+        return [tag % values for tag in self.tags]
+
+
+def register(model, dependencies_class=CacheDependencies):
+    """
+    Expire the caches declared by ``dependencies_class`` whenever an object of
+    ``model`` changes what the public sees.
+    """
+    _registry[model] = dependencies_class()
+    _connect(model)
+    # Objects loaded with ``only()`` or ``defer()`` are instances of generated
+    # subclasses, which are connected as they're created.
+    for other in app_cache.app_models.get(model._meta.app_label, {}).values():
+        if getattr(other, '_deferred', False) \
+            and other._meta.proxy_for_model is model:
+            _connect(other)
+    became_published.connect(_expire_became_published, sender=model)
+    workflow_published.connect(_expire_bulk_changed, sender=model)
+    workflow_unpublished.connect(_expire_bulk_changed, sender=model)
+
+def _connect(model):
+    pre_save.connect(_record_saved, sender=model,
+        dispatch_uid='workflow.expiry'
+    )
+    post_save.connect(_expire_saved, sender=model,
+        dispatch_uid='workflow.expiry'
+    )
+    post_delete.connect(_expire_deleted, sender=model,
+        dispatch_uid='workflow.expiry'
+    )
+
+def _connect_deferred(sender, **kwargs):
+    if getattr(sender, '_deferred', False) \
+        and sender._meta.proxy_for_model in _registry:
+        _connect(sender)
+
+class_prepared.connect(_connect_deferred)
+
+def _get_dependencies(model):
+    # Deferred-field models are generated proxies of the registered model.
+    if getattr(model, '_deferred', False):
+        model = model._meta.proxy_for_model
+    return _registry.get(model)
+
+def is_registered(model):
+    return _get_dependencies(model) is not None
+
+
+def _get_pending():
+    if not hasattr(_local, 'pending'):
+        _local.pending = {}
+    return _local.pending
+
+def expire_objects(objects):
+    """
+    Queue the caches which depend on ``objects`` for expiry. Objects of models
+    which aren't registered are ignored.
+    """
+    pending = _get_pending()
+    for obj in objects:
+        dependencies = _get_dependencies(obj.__class__)
+        if dependencies is None:
+            continue
+        alias = dependencies.cache_alias
+        caches = pending.setdefault(alias, {
+            'views': {}, 'fragments': set(), 'tags': set()
+        })
+        views = caches['views'].setdefault(dependencies.key_prefix, set())
+        for view_name, args in dependencies.get_views(obj):
+            views.add((view_name, tuple(args)))
+        for fragment_name, variables in dependencies.get_fragments(obj):
+            caches['fragments'].add((fragment_name, tuple(variables)))
+        caches['tags'].update(dependencies.get_tags(obj))
+    if not transaction.is_managed():
+        flush_expiry()
+
+def flush_expiry(**kwargs):
+    """
+    Expire every queued cache, one batch per cache. This is called when a
+    request finishes; call it yourself after committing changes outside of a
+    request, e.g. in a management command.
+    """
+    pending = _get_pending()
+    while pending:
+        alias, caches = pending.popitem()
+        batches = [(expire_view_caches, (views,), {
+            'key_prefix': key_prefix,
+            'cache_alias': alias
+        }) for key_prefix, views in caches['views'].items() if views]
+        if caches['fragments']:
+            batches.append((invalidate_template_caches,
+                (caches['fragments'],), {'cache_alias': alias}
+            ))
+        if caches['tags']:
+            batches.append((bump_tags, tuple(caches['tags']),
+                {'cache_alias': alias}
+            ))
+        # A failing batch (e.g. a view that can't be reversed) mustn't keep
+        # the others from being expired, or escape from ``request_finished``.
+        for func, args, kwargs in batches:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Couldn't expire the caches of %s.",
+                    func.__name__
+                )
+
+request_finished.connect(flush_expiry)
+
+
+def _get_state(instance):
+    # The status and, with postdated publishing, the date of ``instance``, or
+    # None if either is deferred. Reading them doesn't query the database.
+    opts = instance._meta
+    names = ['status']
+    if ENABLE_POSTDATED_PUBLISHING and opts.get_latest_by:
+        names.append(opts.get_latest_by)
+    state = []
+    for name in names:
+        attname = opts.get_field(name).attname
+        if attname not in instance.__dict__:
+            return None
+        state.append(instance.__dict__[attname])
+    return tuple(state)
+
+def _is_live(state):
+    # Whether an object in ``state`` is published, or goes live within the
+    # current ``PUBLISH_TIME_QUANTUM`` (``published()`` rounds "now" down, so
+    # it may not show such an object yet, but will before its caches would
+    # otherwise expire). An unknown state counts as published.
+    if state is None:
+        return True
+    if state[0] != PUBLISHED_STATE:
+        return False
+    if len(state) == 1 or state[1] is None:
+        return True
+    horizon = get_current_datetime() + timedelta(seconds=PUBLISH_TIME_QUANTUM)
+    return get_go_live_datetime(state[1]) <= horizon
+
+def _record_saved(sender, instance, **kwargs):
+    # The stored object, whose caches are expired too if it was live: its
+    # view arguments may differ from those of ``instance``.
+    if instance.pk is None:
+        return
+    if getattr(sender, '_deferred', False):
+        sender = sender._meta.proxy_for_model
+    stored = sender._base_manager.filter(pk=instance.pk)[:1]
+    instance._workflow_stored = stored and stored[0] or None
+
+def _expire_saved(sender, instance, **kwargs):
+    # Edits to a published object change what the public sees as much as
+    # (un)publishing it does.
+    stored = instance.__dict__.pop('_workflow_stored', None)
+    objects = []
+    if stored is not None and _is_live(_get_state(stored)):
+        objects.append(stored)
+    if _is_live(_get_state(instance)):
+        objects.append(instance)
+    if objects:
+        expire_objects(objects)
+
+def _expire_deleted(sender, instance, **kwargs):
+    if _is_live(_get_state(instance)):
+        expire_objects([instance])
+
+def _expire_became_published(sender, instance, **kwargs):
+    expire_objects([instance])
+
+def _expire_bulk_changed(sender, pks, **kwargs):
+    # The objects are loaded after their status has changed, in chunks.
+    manager = sender._base_manager
+    chunk_size = BULK_PUBLISH_CHUNK_SIZE
+    for i in range(0, len(pks), chunk_size):
+        expire_objects(manager.filter(pk__in=pks[i:i + chunk_size]))
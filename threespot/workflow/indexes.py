@@ -0,0 +1,158 @@
+import re
+
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_syncdb
+
+from threespot.workflow.app_settings import PUBLISHED_STATE, \
+    CREATE_STATUS_DATE_INDEXES
+
+"""
+Composite indexes for postdated workflow models.
+
+``WorkflowManager.published()`` filters on ``status`` and the model's
+``get_latest_by`` field and usually orders by the latter, so a postdated
+model is best served by an index on ``(status, <date>)``. Where the database
+supports partial indexes (PostgreSQL and SQLite), an index on ``<date>``
+covering only the published rows is created as well.
+
+Django can't declare multi-column indexes on models, so these are created
+with raw SQL when ``syncdb`` creates a model's table, if the
+``WORKFLOW_CREATE_STATUS_DATE_INDEXES`` setting is on. The
+``check_workflow_indexes`` management command reports (and, with
+``--create``, creates) the ones missing from existing tables.
+"""
+
+PARTIAL_INDEX_VENDORS = ('postgresql', 'sqlite')
+
+
+def _get_columns(model):
+    opts = model._meta
+    return (
+        opts.get_field('status').column,
+        opts.get_field(opts.get_latest_by).column
+    )
+
+def _get_index_name(model, suffix):
+    # Keep within the 63 character limit of PostgreSQL.
+    return ('%s_%s' % (model._meta.db_table, suffix))[:63]
+
+def get_indexed_models():
+    """
+    Return the postdated workflow models whose tables should have the
+    indexes: those whose own table holds both the status and the date
+    columns. Proxies and multi-table subclasses are served by the indexes of
+    the table their fields live in.
+    """
+    from threespot.workflow.scheduler import get_postdated_models
+    indexed = []
+    for model in get_postdated_models():
+        opts = model._meta
+        local_names = [f.name for f in opts.local_fields]
+        if not opts.proxy and 'status' in local_names \
+            and opts.get_latest_by in local_names:
+            indexed.append(model)
+    return indexed
+
+def get_index_statements(model, connection):
+    """
+    Return a list of ``(index name, SQL)`` pairs creating the indexes the
+    given postdated workflow model should have.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    status_column, date_column = _get_columns(model)
+    composite_name = _get_index_name(model, 'status_date_idx')
+    statements = [(composite_name, 'CREATE INDEX %s ON %s (%s, %s);' % (
+        qn(composite_name), qn(table), qn(status_column), qn(date_column)
+    ))]
+    if connection.vendor in PARTIAL_INDEX_VENDORS:
+        partial_name = _get_index_name(model, 'published_date_idx')
+        statements.append((partial_name,
+            "CREATE INDEX %s ON %s (%s) WHERE %s = '%s';" % (
+                qn(partial_name), qn(table), qn(date_column),
+                qn(status_column), PUBLISHED_STATE.replace("'", "''")
+            )
+        ))
+    return statements
+
+def _get_index_columns(cursor, connection, table):
+    # Return a dictionary of index name -> list of indexed columns for the
+    # given table, or None if the database isn't supported.
+    indexes = {}
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % connection.ops.quote_name(table))
+        for row in cursor.fetchall():
+            name = row[1]
+            cursor.execute(
+                'PRAGMA index_info(%s)' % connection.ops.quote_name(name)
+            )
+            indexes[name] = [r[2] for r in sorted(cursor.fetchall())]
+    elif connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        for row in cursor.fetchall():
+            # Key_name, Seq_in_index, Column_name
+            indexes.setdefault(row[2], []).append((row[3], row[4]))
+        for name, columns in indexes.items():
+            indexes[name] = [column for _, column in sorted(columns)]
+    elif connection.vendor == 'postgresql':
+        cursor.execute(
+            'SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s',
+            [table]
+        )
+        for name, definition in cursor.fetchall():
+            match = re.search(r'\((.*?)\)', definition)
+            if match:
+                indexes[name] = [c.strip().strip('"') \
+                    for c in match.group(1).split(',')
+                ]
+    else:
+        return None
+    return indexes
+
+def get_missing_indexes(model, using=DEFAULT_DB_ALIAS):
+    """
+    Return the ``(index name, SQL)`` pairs of the indexes missing from the
+    table of the given postdated workflow model, or None if the database
+    can't be checked. A composite index is considered present if any index
+    starts with the status and date columns.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    indexes = _get_index_columns(cursor, connection, model._meta.db_table)
+    if indexes is None:
+        return None
+    columns = list(_get_columns(model))
+    has_composite = any(c[:2] == columns for c in indexes.values())
+    missing = []
+    for name, sql in get_index_statements(model, connection):
+        if name in indexes:
+            continue
+        if name.endswith('status_date_idx') and has_composite:
+            continue
+        missing.append((name, sql))
+    return missing
+
+
+def _create_indexes(sender, created_models, verbosity=1, db=DEFAULT_DB_ALIAS,\
+    **kwargs):
+    # Create the indexes of the postdated workflow models syncdb has just
+    # created the tables of.
+    connection = connections[db]
+    # The signal is sent once per app, with all the created models.
+    app_models = set(models.get_models(sender))
+    cursor = connection.cursor()
+    for model in get_indexed_models():
+        if model not in created_models or model not in app_models:
+            continue
+        # ``flush`` sends the signal too, with every model as created.
+        statements = get_missing_indexes(model, using=db)
+        if statements is None:
+            statements = get_index_statements(model, connection)
+        for name, sql in statements:
+            if verbosity >= 2:
+                print "Creating workflow index %s" % name
+            cursor.execute(sql)
+    transaction.commit_unless_managed(using=db)
+
+if CREATE_STATUS_DATE_INDEXES:
+    post_syncdb.connect(_create_indexes)
@@ -0,0 +1,198 @@
+import threading
+import traceback
+from datetime import timedelta
+
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.utils.encoding import force_unicode
+
+from threespot.workflow.app_settings import MERGE_CHUNK_SIZE, \
+    MERGE_JOBS_IN_PROCESS, MERGE_JOB_TIMEOUT
+from threespot.workflow.drafts import count_references, merge_item
+from threespot.workflow.expiry import flush_expiry
+from threespot.workflow.models import MergeJob
+from threespot.workflow.utils import get_current_datetime
+
+"""
+Background merge jobs.
+
+Merging a draft copy of an object with thousands of references can take too
+long for a request. ``WorkflowAdmin`` can instead queue the merge as a
+``MergeJob`` in the database (see its ``merge_in_background`` option), to be
+run by the ``run_merge_jobs`` management command, or by a thread of the web
+process if the ``WORKFLOW_MERGE_JOBS_IN_PROCESS`` setting is on (the thread
+is started once the request which queued the job has finished, so that the
+job has been committed). A job repoints the references in transactions of ``WORKFLOW_MERGE_CHUNK_SIZE`` rows
+and records its progress as it goes. If it fails part way, the references it
+has repointed stay repointed and the job can be queued again to finish.
+A running job which hasn't recorded any progress for
+``WORKFLOW_MERGE_JOB_TIMEOUT`` seconds is taken to have been abandoned by a
+worker which died, and is queued again.
+"""
+
+def enqueue_merge(original, draft_copy, slug_field=None, user=None):
+    """
+    Queue the merge of ``draft_copy`` over ``original`` and return the job.
+    """
+    job = MergeJob.objects.create(
+        content_type=ContentType.objects.get_for_model(original),
+        original_id=original.pk,
+        draft_id=draft_copy.pk,
+        slug_field=slug_field or '',
+        user=user
+    )
+    if MERGE_JOBS_IN_PROCESS:
+        if transaction.is_managed():
+            # The job must be committed before the thread can see it.
+            _local.start_worker = True
+        else:
+            transaction.commit_unless_managed()
+            start_worker_thread()
+    return job
+
+def requeue_stale_jobs():
+    """
+    Queue the running jobs which haven't recorded any progress for
+    ``WORKFLOW_MERGE_JOB_TIMEOUT`` seconds again. Returns their number.
+    """
+    cutoff = get_current_datetime() - timedelta(seconds=MERGE_JOB_TIMEOUT)
+    requeued = MergeJob.objects.filter(
+        status=MergeJob.RUNNING, heartbeat__lt=cutoff
+    ).update(status=MergeJob.QUEUED)
+    transaction.commit_unless_managed()
+    return requeued
+
+def get_pending_job(draft_copy):
+    """ Return the queued or running merge job of ``draft_copy``, if any."""
+    requeue_stale_jobs()
+    jobs = MergeJob.objects.filter(
+        content_type=ContentType.objects.get_for_model(draft_copy),
+        draft_id=draft_copy.pk,
+        status__in=(MergeJob.QUEUED, MergeJob.RUNNING)
+    )[:1]
+    return jobs and jobs[0] or None
+
+def claim_job(job):
+    """
+    Mark a queued job as running. Returns False if another worker has
+    already claimed it.
+    """
+    now = get_current_datetime()
+    claimed = MergeJob.objects.filter(
+        pk=job.pk, status=MergeJob.QUEUED
+    ).update(status=MergeJob.RUNNING, started=now, heartbeat=now, progress=0)
+    transaction.commit_unless_managed()
+    if claimed:
+        job.status, job.progress = MergeJob.RUNNING, 0
+        job.started = job.heartbeat = now
+    return bool(claimed)
+
+@transaction.commit_manually
+def run_job(job, chunk_size=None):
+    """
+    Run a claimed merge job, committing after every ``chunk_size``
+    references.
+    """
+    try:
+        model = job.content_type.model_class()
+        original = model._base_manager.get(pk=job.original_id)
+        draft_copy = model._base_manager.get(pk=job.draft_id)
+        job.total = count_references(original, draft_copy)
+        MergeJob.objects.filter(pk=job.pk).update(total=job.total)
+        transaction.commit()
+
+        def progress(count):
+            job.progress += count
+            job.heartbeat = get_current_datetime()
+            MergeJob.objects.filter(pk=job.pk).update(
+                progress=job.progress, heartbeat=job.heartbeat
+            )
+            transaction.commit()
+
+        merge_item(original, draft_copy,
+            slug_field=job.slug_field or None,
+            chunk_size=chunk_size or MERGE_CHUNK_SIZE,
+            progress=progress
+        )
+        # Reassign the admin log entries of the old object to the new one.
+        LogEntry.objects.filter(
+            content_type=job.content_type,
+            object_id=job.original_id
+        ).update(object_id=draft_copy.pk)
+        if job.user:
+            LogEntry.objects.log_action(
+                user_id=job.user.pk,
+                content_type_id=job.content_type.pk,
+                object_id=draft_copy.pk,
+                object_repr=force_unicode(draft_copy),
+                action_flag=CHANGE,
+                change_message='Merged %s "%s".' % (
+                    force_unicode(draft_copy._meta.verbose_name),
+                    force_unicode(draft_copy)
+                )
+            )
+        job.status = MergeJob.DONE
+        job.finished = get_current_datetime()
+        job.save()
+        transaction.commit()
+    except Exception:
+        transaction.rollback()
+        job.status = MergeJob.FAILED
+        job.error = traceback.format_exc()
+        job.finished = get_current_datetime()
+        job.save()
+        transaction.commit()
+    flush_expiry()
+    return job
+
+def run_pending_jobs(chunk_size=None):
+    """
+    Run the queued jobs, oldest first, until there are none left. Returns
+    the jobs that were run.
+    """
+    run = []
+    requeue_stale_jobs()
+    while True:
+        jobs = MergeJob.objects.filter(status=MergeJob.QUEUED)[:1]
+        if not jobs:
+            return run
+        job = jobs[0]
+        if claim_job(job):
+            run.append(run_job(job, chunk_size))
+
+
+_local = threading.local()
+_worker_lock = threading.Lock()
+_worker_thread = None
+
+def _run_worker():
+    try:
+        run_pending_jobs()
+    finally:
+        # Each thread has its own connection, which would be left open.
+        connection.close()
+
+def start_worker_thread():
+    """
+    Run the pending jobs in a background thread of this process, unless one
+    is already doing so.
+    """
+    global _worker_thread
+    _worker_lock.acquire()
+    try:
+        if _worker_thread is None or not _worker_thread.isAlive():
+            _worker_thread = threading.Thread(target=_run_worker)
+            _worker_thread.setDaemon(True)
+            _worker_thread.start()
+    finally:
+        _worker_lock.release()
+
+def _start_queued_worker(**kwargs):
+    if getattr(_local, 'start_worker', False):
+        _local.start_worker = False
+        start_worker_thread()
+
+if MERGE_JOBS_IN_PROCESS:
+    request_finished.connect(_start_queued_worker)
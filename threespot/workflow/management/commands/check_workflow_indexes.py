@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from threespot.workflow.indexes import get_indexed_models, \
+    get_missing_indexes
+
+class Command(BaseCommand):
+    
+    """
+    This Django management command reports the workflow models with
+    postdated publishing whose tables lack the composite status and date
+    index (or the partial index of published rows) that
+    ``WorkflowManager.published()`` queries need. It is run thusly:
+        
+        $>./manage.py check_workflow_indexes [--create] [--database=default]
+    
+    With ``--create``, it creates the missing indexes.
+    
+    """
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--create', action='store_true', dest='create',
+            default=False, help='Create the missing indexes.'
+        ),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='The database to check. Defaults to the "default" database.'
+        ),
+    )
+    help = 'Reports the workflow models missing their status and date index.'
+    
+    def handle(self, *args, **options):
+        using = options['database']
+        cursor = connections[using].cursor()
+        for model in get_indexed_models():
+            label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+            missing = get_missing_indexes(model, using=using)
+            if missing is None:
+                self.stdout.write(
+                    "Can't check the indexes of %s on this database.\n" % label
+                )
+                continue
+            for name, sql in missing:
+                if options['create']:
+                    cursor.execute(sql)
+                    self.stdout.write("Created %s on %s.\n" % (name, label))
+                else:
+                    self.stdout.write("%s is missing %s:\n    %s\n" % (
+                        label, name, sql
+                    ))
+        if options['create']:
+            transaction.commit_unless_managed(using=using)
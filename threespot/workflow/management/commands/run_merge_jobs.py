@@ -0,0 +1,54 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections, reset_queries
+
+from threespot.workflow.jobs import run_pending_jobs
+
+class Command(BaseCommand):
+    
+    """
+    This Django management command runs the draft copy merges queued by
+    ``WorkflowAdmin`` when its ``merge_in_background`` option is on. It is
+    run thusly:
+        
+        $>./manage.py run_merge_jobs [--poll=10] [--chunk-size=500]
+    
+    It runs until interrupted, checking for queued merges every ``--poll``
+    seconds. Alternatively, run it from a cron job with ``--once``: it then
+    runs the queued merges and exits.
+    
+    """
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', type='int', dest='poll', default=10,
+            help='Seconds between checks for queued merges.'
+        ),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=None,
+            help='References to repoint per transaction.'
+        ),
+        make_option('--once', action='store_true', dest='once',
+            default=False,
+            help='Run the queued merges and exit.'
+        ),
+    )
+    help = 'Runs the queued background merges of draft copies.'
+    
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            for job in run_pending_jobs(chunk_size=options['chunk_size']):
+                if verbosity > 0:
+                    self.stdout.write("%s: %s.\n" % (
+                        job, job.get_status_display()
+                    ))
+            if options['once']:
+                return
+            # End the transaction of the last check, so the next one sees
+            # the jobs queued meanwhile.
+            for connection in connections.all():
+                connection.close()
+            reset_queries()
+            time.sleep(options['poll'])
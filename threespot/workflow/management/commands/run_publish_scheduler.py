@@ -0,0 +1,52 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from threespot.workflow.scheduler import PublishScheduler
+from threespot.workflow.utils import get_current_datetime
+
+class Command(BaseCommand):
+    
+    """
+    This Django management command runs the workflow publish scheduler, which
+    sends the ``became_published`` signal for each postdated, published
+    object as it goes live. It is run thusly:
+        
+        $>./manage.py run_publish_scheduler [--refresh=300]
+    
+    It runs until interrupted, reloading the upcoming publish times every
+    ``--refresh`` seconds. Alternatively, run it from a cron job with 
+    ``--since=N``: it then sends the signal for the objects which went live
+    in the last N minutes and exits.
+    
+    """
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh', type='int', dest='refresh', default=300,
+            help='Seconds between reloads of the upcoming publish times.'
+        ),
+        make_option('--since', type='int', dest='since', default=None,
+            help=('Publish the objects which went live in the last SINCE '
+                'minutes and exit.')
+        ),
+    )
+    help = 'Sends the became_published signal as postdated content goes live.'
+    
+    def handle(self, *args, **options):
+        scheduler = PublishScheduler()
+        verbosity = int(options.get('verbosity', 1))
+        if options['since'] is not None:
+            now = get_current_datetime()
+            scheduler.load(since=now - timedelta(minutes=options['since']))
+            for obj in scheduler.run_pending(now):
+                if verbosity > 0:
+                    self.stdout.write("Published %s %s.\n" % (
+                        obj._meta.verbose_name, obj.pk
+                    ))
+            return
+        scheduler.run(
+            refresh_interval=options['refresh'],
+            verbosity=verbosity,
+            stdout=self.stdout
+        )
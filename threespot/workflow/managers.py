@@ -1,12 +1,119 @@
+import threading
+
+import django
+from django.core.signals import request_started, request_finished
 from django.db import models
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
+
+from threespot.workflow.app_settings import ENABLE_POSTDATED_PUBLISHING, \
+    PUBLISHED_STATE, UNPUBLISHED_STATES, CACHE_PUBLISHED_QUERYSETS, \
+    BULK_PUBLISH_CHUNK_SIZE
+from threespot.workflow.signals import workflow_published, \
+    workflow_unpublished
+from threespot.workflow.utils import get_publish_datetime, \
+    get_go_live_datetime, get_current_datetime
+
+# The request-scoped cache of ``published()`` and ``unpublished()``
+# querysets, by model. It's only active while a request is being handled.
+_queryset_cache = threading.local()
+
+def _start_queryset_cache(**kwargs):
+    _queryset_cache.querysets = {}
+
+def _stop_queryset_cache(**kwargs):
+    _queryset_cache.querysets = None
+
+def clear_queryset_cache(model=None):
+    """
+    Forget the cached querysets of ``model``, or of every model. This is done
+    whenever an object is saved or deleted; call it after changing objects
+    with ``QuerySet.update()``.
+    """
+    querysets = getattr(_queryset_cache, 'querysets', None)
+    if querysets:
+        if model is None:
+            querysets.clear()
+        else:
+            querysets.pop(model, None)
+
+def _clear_model_queryset_cache(sender, **kwargs):
+    # Objects loaded with ``only()`` or ``defer()`` are instances of generated
+    # proxies, and objects of multi-table subclasses are also rows of their
+    # parents' tables.
+    models = [sender]
+    while models[-1]._meta.proxy:
+        models.append(models[-1]._meta.proxy_for_model)
+    models.extend(models[-1]._meta.get_parent_list())
+    for model in models:
+        clear_queryset_cache(model)
+
+if CACHE_PUBLISHED_QUERYSETS:
+    request_started.connect(_start_queryset_cache)
+    request_finished.connect(_stop_queryset_cache)
+    post_save.connect(_clear_model_queryset_cache)
+    post_delete.connect(_clear_model_queryset_cache)
+
+class WorkflowQuerySet(QuerySet):
+    """
+    A queryset of workflow objects.
+    """
+
+    def published_subset(self):
+        """
+        Returns the published objects of this queryset, taking postdated
+        publishing into account. Use it in admin actions and the like to
+        check a selection with one query, e.g.
+        ``queryset.published_subset().exists()``.
+        """
+        filter_kwargs = {'status': PUBLISHED_STATE}
+        if ENABLE_POSTDATED_PUBLISHING and self.model._meta.get_latest_by:
+            field_name = self.model._meta.get_latest_by + "__lte"
+            filter_kwargs[field_name] = get_publish_datetime()
+        return self.filter(**filter_kwargs)
+
+    def _set_status(self, status, signal, chunk_size=None):
+        # Give the objects of this queryset which don't have it ``status``,
+        # ``chunk_size`` rows per ``UPDATE``, then send ``signal`` with their
+        # primary keys. Returns the number of objects changed.
+        chunk_size = chunk_size or BULK_PUBLISH_CHUNK_SIZE
+        pks = list(self.exclude(status=status).values_list('pk', flat=True))
+        manager = self.model._base_manager.db_manager(self.db)
+        for i in range(0, len(pks), chunk_size):
+            manager.filter(pk__in=pks[i:i + chunk_size]).update(status=status)
+        if pks:
+            clear_queryset_cache(self.model)
+            signal.send(sender=self.model, pks=pks)
+        return len(pks)
+
+    def publish(self, chunk_size=None):
+        """
+        Publishes the objects of this queryset with a few ``UPDATE``
+        statements, rather than by saving each one, and sends the
+        ``workflow_published`` signal with the primary keys of the objects
+        which weren't published already. Returns their number.
+        ``chunk_size`` defaults to the ``WORKFLOW_BULK_PUBLISH_CHUNK_SIZE``
+        setting.
+        """
+        return self._set_status(PUBLISHED_STATE, workflow_published,
+            chunk_size
+        )
+
+    def unpublish(self, status=UNPUBLISHED_STATES[0][0], chunk_size=None):
+        """
+        Gives the objects of this queryset the unpublished ``status`` like
+        ``publish()``, sending the ``workflow_unpublished`` signal.
+        """
+        return self._set_status(status, workflow_unpublished, chunk_size)
 
-from threespot.workflow.app_settings import ENABLE_POSTDATED_PUBLISHING, PUBLISHED_STATE
-from threespot.workflow.utils import get_current_datetime
 
 class WorkflowManager(models.Manager): 
     """
     A manager used to fetch published objects.
     """
+
+    def get_query_set(self):
+        return WorkflowQuerySet(self.model, using=self._db)
     
     @staticmethod
     def _extract_select_related_args(select_related):
@@ -14,21 +121,23 @@ class WorkflowManager(models.Manager):
         Parses possible ``select_related`` arguments into a set
         of useable args and kwargs for Django's ``select_related``
         queryset. If ``True``, ``select_related`` will be called with
-        no arguments, if a tuple, those will be assumed to be the
+        no arguments, if a tuple or list, those will be assumed to be the
         exact FK fields to follow, if an integer, ``depth=N`` will
         be passed.
         """
+        # Check for booleans first: ``True`` is also an integer.
         if select_related is True:
             args, kwargs = [], {}
-        elif type(select_related) == tuple:
+        elif isinstance(select_related, (tuple, list)):
             args, kwargs = select_related, {}
-        elif type(select_related) == int:
-            args, kwargs = [], {'depth': int}
+        elif isinstance(select_related, (int, long)) \
+            and not isinstance(select_related, bool):
+            args, kwargs = [], {'depth': select_related}
         else:
             raise TypeError((
                 "The argument passed to _extract_select_related_args needs to "
-                "be a boolean, tuple, or string. You passed an argument of "
-                "the type %r."
+                "be a boolean, tuple, list or integer. You passed an argument "
+                "of the type %r."
             ) % type(select_related))
         return args, kwargs
 
@@ -63,38 +172,145 @@ class WorkflowManager(models.Manager):
             return field_name + "__gt"
         return None
 
-    def _get_expanded_queryset(self, select_related=None):
-        # Patches ``select_related`` into the standard get_query_set method on
-        # a model manager.
+    def _get_expanded_queryset(self, select_related=None,\
+        prefetch_related=None, only=None, defer=None):
+        # Patches ``select_related``, ``prefetch_related``, ``only`` and
+        # ``defer`` into the standard get_query_set method on a model manager.
+        qs = self.get_query_set()
         if select_related:
             args, kwargs = self._extract_select_related_args(select_related)
-            qs = self.get_query_set().select_related(*args, **kwargs)
-        else:
-            qs = self.get_query_set()
+            qs = qs.select_related(*args, **kwargs)
+        if prefetch_related:
+            if not hasattr(qs, 'prefetch_related'):
+                raise TypeError((
+                    "The prefetch_related argument requires Django 1.4 or "
+                    "later; this is Django %s."
+                ) % django.get_version())
+            qs = qs.prefetch_related(*prefetch_related)
+        if only:
+            qs = qs.only(*only)
+        if defer:
+            qs = qs.defer(*defer)
         return qs
+
+    @staticmethod
+    def _get_expansion_key(expansion):
+        # A hashable version of the ``_get_expanded_queryset`` arguments, for
+        # the queryset cache. Types are part of it, as ``True == 1``.
+        key = []
+        for name, value in sorted(expansion.items()):
+            if isinstance(value, (list, tuple)):
+                value = tuple(value)
+            key.append((name, type(value), value))
+        return tuple(key)
     
-    def published(self, select_related=None):
-        """ Returns all published items."""
-        qs = self._get_expanded_queryset(select_related=select_related)
+    def _get_cached_queryset(self, key, get_queryset):
+        # Return the queryset cached under ``key`` for this request, calling
+        # ``get_queryset`` to create it if needed. Once the queryset has been
+        # evaluated, its results are reused too.
+        querysets = getattr(_queryset_cache, 'querysets', None)
+        # Related managers filter by the instance they belong to.
+        if querysets is None or hasattr(self, 'core_filters'):
+            return get_queryset()
+        key = (self.__class__, self._db) + key
+        model_querysets = querysets.setdefault(self.model, {})
+        qs = model_querysets.get(key)
+        if qs is None:
+            qs = model_querysets[key] = get_queryset()
+        return qs
+
+    def _get_now(self):
+        # The cached querysets are keyed by "now", which is rounded by the
+        # ``PUBLISH_TIME_QUANTUM`` setting.
+        return get_publish_datetime()
+
+    def published(self, select_related=None, prefetch_related=None,\
+        only=None, defer=None):
+        """
+        Returns all published items.
+
+        ``select_related`` may be ``True``, a tuple or list of the relations
+        to follow, or a depth. ``prefetch_related`` (Django 1.4 and later),
+        ``only`` and ``defer`` take tuples or lists of field names. The same
+        arguments are accepted by ``unpublished()`` and ``draft_copies()``.
+        """
+        expansion = {
+            'select_related': select_related,
+            'prefetch_related': prefetch_related,
+            'only': only,
+            'defer': defer
+        }
         filter_kwargs = {'status': PUBLISHED_STATE}
         postdate_kwarg = self.get_postdate_publish_filter_kwarg()
         if postdate_kwarg:
-            now = get_current_datetime()
-            filter_kwargs[postdate_kwarg] = now
-        return qs.filter(**filter_kwargs)
+            filter_kwargs[postdate_kwarg] = self._get_now()
+        def get_queryset():
+            qs = self._get_expanded_queryset(**expansion)
+            return qs.filter(**filter_kwargs)
+        key = ('published', self._get_expansion_key(expansion)) + \
+            tuple(sorted(filter_kwargs.items()))
+        return self._get_cached_queryset(key, get_queryset)
     
-    def unpublished(self, select_related=None):
+    def unpublished(self, select_related=None, prefetch_related=None,\
+        only=None, defer=None):
         """ Returns all unpublished objects."""
-        qs = self._get_expanded_queryset(select_related=select_related)
+        expansion = {
+            'select_related': select_related,
+            'prefetch_related': prefetch_related,
+            'only': only,
+            'defer': defer
+        }
         postdate_kw = self.get_postdate_unpublish_filter_kwarg()
-        if postdate_kw:
-            now = get_current_datetime()
-            return qs.filter(
-                ~models.Q(status=PUBLISHED_STATE) | models.Q(**{postdate_kw: now})
-            )
-        return qs.exclude(status=PUBLISHED_STATE)        
+        now = postdate_kw and self._get_now() or None
+        def get_queryset():
+            qs = self._get_expanded_queryset(**expansion)
+            if postdate_kw:
+                return qs.filter(
+                    ~models.Q(status=PUBLISHED_STATE) | \
+                    models.Q(**{postdate_kw: now})
+                )
+            return qs.exclude(status=PUBLISHED_STATE)
+        key = ('unpublished', self._get_expansion_key(expansion), postdate_kw,
+            now
+        )
+        return self._get_cached_queryset(key, get_queryset)
     
-    def draft_copies(self, select_related=None):
+    def next_publish_datetime(self):
+        """
+        Returns the datetime at which the next postdated item goes live, or
+        None if there isn't one (or ``ENABLE_POSTDATED_PUBLISHING`` is off).
+        This is a single indexed lookup of the earliest future date.
+        """
+        field_name = self._get_postdate_field()
+        if not field_name:
+            return None
+        dates = self.get_query_set().filter(**{
+            'status': PUBLISHED_STATE,
+            self.get_postdate_unpublish_filter_kwarg(): self._get_now()
+        }).order_by(field_name).values_list(field_name, flat=True)[:1]
+        if not dates:
+            return None
+        return get_go_live_datetime(dates[0])
+
+    def get_cache_timeout(self, timeout):
+        """
+        Returns ``timeout``, shortened if needed so that a cache entry set now
+        expires as the next postdated item goes live.
+        """
+        next_publish = self.next_publish_datetime()
+        if next_publish is None:
+            return timeout
+        delta = next_publish - get_current_datetime()
+        seconds = delta.days * 86400 + delta.seconds + 1
+        return max(1, min(timeout, seconds))
+
+    def draft_copies(self, select_related=None, prefetch_related=None,\
+        only=None, defer=None):
         """ Returns all draft copies."""
-        qs = self._get_expanded_queryset(select_related=select_related)
-        return qs.exclude(copy_of__exact=None)
\ No newline at end of file
+        qs = self._get_expanded_queryset(
+            select_related=select_related,
+            prefetch_related=prefetch_related,
+            only=only,
+            defer=defer
+        )
+        return qs.exclude(copy_of__exact=None)
@@ -1,14 +1,20 @@
 from copy import copy
 from datetime import datetime, date
 
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
+# Connects the syncdb handler creating the status and date indexes.
+import threespot.workflow.indexes
+# Connects the handlers expiring the cached reference previews.
+import threespot.workflow.references
 from threespot.workflow.app_settings import WORKFLOW_CHOICES, PUBLISHED_STATE, \
     UNPUBLISHED_STATES, DEFAULT_STATE, ADDITIONAL_STATUS_KWARGS, \
     ENABLE_POSTDATED_PUBLISHING
 from threespot.workflow.managers import WorkflowManager
-from threespot.workflow.utils import get_current_datetime
+from threespot.workflow.utils import get_publish_datetime
 
 status_kwargs = {
     'choices': WORKFLOW_CHOICES,
@@ -56,8 +62,7 @@ class BaseWorkflowMixin(models.Model):
             if date_field:
                 date_val = getattr(self, date_field)
                 if isinstance(date_val, datetime):
-                    now = get_current_datetime()
-                    return date_val <= now
+                    return date_val <= get_publish_datetime()
                 if isinstance(date_val, date):
                     return date_val <= date.today()
         return True
@@ -96,4 +101,52 @@ class WorkflowInlineMixin(BaseWorkflowMixin):
     status = models.CharField(_("Status"), **inline_status_kwargs)
     
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
+
+
+class MergeJob(models.Model):
+    """
+    A draft copy merge queued to run in the background. See
+    ``threespot.workflow.jobs``.
+    """
+    QUEUED, RUNNING, DONE, FAILED = 'q', 'r', 'd', 'f'
+    STATUS_CHOICES = (
+        (QUEUED, _('Queued')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+    content_type = models.ForeignKey(ContentType)
+    original_id = models.PositiveIntegerField()
+    draft_id = models.PositiveIntegerField()
+    slug_field = models.CharField(max_length=100, blank=True)
+    user = models.ForeignKey(User, blank=True, null=True)
+    status = models.CharField(_("Status"), max_length=1,
+        choices=STATUS_CHOICES, default=QUEUED, db_index=True
+    )
+    total = models.PositiveIntegerField(default=0)
+    progress = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ('created',)
+    
+    def __unicode__(self):
+        return u'Merge of %s %s into %s' % (
+            self.content_type, self.draft_id, self.original_id
+        )
+    
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+    
+    def get_percent_done(self):
+        """ The share of the references repointed so far, as a percentage."""
+        if self.status == self.DONE:
+            return 100
+        if not self.total:
+            return 0
+        return min(100, 100 * self.progress // self.total)
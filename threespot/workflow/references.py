@@ -0,0 +1,265 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+    post_delete, m2m_changed, class_prepared
+from django.utils.encoding import force_unicode
+from django.utils.hashcompat import md5_constructor
+
+from threespot.cache.tags import bump_tags, get_tags_hash
+from threespot.orm.introspect import get_referencing_models, \
+    get_generic_referencing_models, get_referencing_querysets, \
+    get_generic_referencing_querysets
+from threespot.workflow.app_settings import REFERENCE_PREVIEW_TIMEOUT, \
+    REFERENCE_PREVIEW_LIMIT
+
+"""
+Cached summaries of the objects referencing a workflow object.
+
+The copy and merge confirmation pages list the objects which reference the
+object being copied or merged. ``get_reference_preview()`` counts them per
+referencing model and lists a few of each, and caches the result for
+``WORKFLOW_REFERENCE_PREVIEW_TIMEOUT`` seconds, keyed by the object and by the
+set of relations to its model. Saving, deleting or (un)relating an object
+which refers to workflow objects bumps a cache tag of each of those objects
+(see ``threespot.cache.tags``), so their cached previews are never shown out
+of date. Changes made with ``QuerySet.update()`` send no signals; call
+``expire_reference_previews(model, pks)`` after making them.
+"""
+
+KEY_PREFIX = 'threespot.workflow.references.'
+
+# Maps a model to its fields which refer to workflow objects. Lazy relations
+# are resolved as models are prepared, so it's cleared whenever one is.
+_reference_fields = {}
+
+def _clear_reference_fields(**kwargs):
+    _reference_fields.clear()
+
+class_prepared.connect(_clear_reference_fields)
+
+
+def _get_tag(model, pk):
+    return 'workflow.references:%s.%s:%s' % (
+        model._meta.app_label, model._meta.module_name, pk
+    )
+
+def _get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+def _get_relations_hash(model):
+    # A hash of the relations to ``model``, so that previews cached before a
+    # relation was added or removed aren't used.
+    relations = []
+    for data in get_referencing_models(model):
+        relations.extend('%s.%s' % (_get_label(data['model']), name) \
+            for name in data['field_names'] + data['m2m_field_names']
+        )
+    for generic_model, _ in get_generic_referencing_models():
+        relations.append(_get_label(generic_model))
+    return md5_constructor(','.join(sorted(relations))).hexdigest()
+
+def _get_cache_key(obj, exclude, limit):
+    model = obj.__class__
+    key = ':'.join([
+        _get_label(model), str(obj.pk),
+        exclude is not None and '%s.%s' % (
+            _get_label(exclude.__class__), exclude.pk
+        ) or '',
+        str(limit),
+        _get_relations_hash(model),
+        get_tags_hash([_get_tag(model, obj.pk)])
+    ])
+    return KEY_PREFIX + md5_constructor(key).hexdigest()
+
+def _build_preview(obj, exclude, limit):
+    def get_queryset(model):
+        queryset = model._default_manager.all()
+        if exclude is not None and model == exclude.__class__:
+            queryset = queryset.exclude(pk=exclude.pk)
+        return queryset
+    querysets = get_referencing_querysets(obj, get_queryset) + \
+        get_generic_referencing_querysets(obj, get_queryset)
+    preview = []
+    for queryset in querysets:
+        # An object related through several fields would be listed twice.
+        queryset = queryset.distinct()
+        objects = list(queryset[:limit])
+        if not objects:
+            continue
+        # Only count when the sample may not be all of them.
+        if len(objects) < limit:
+            count = len(objects)
+        else:
+            count = queryset.count()
+        opts = queryset.model._meta
+        preview.append({
+            'verbose_name': force_unicode(opts.verbose_name),
+            'verbose_name_plural': force_unicode(opts.verbose_name_plural),
+            'count': count,
+            'objects': [force_unicode(o) for o in objects],
+            'has_more': count > len(objects)
+        })
+    return preview
+
+def get_reference_preview(obj, exclude=None, limit=None):
+    """
+    Return a summary of the objects referencing ``obj``, as a list of
+    dictionaries, one per referencing model with any references:
+
+        {
+            'verbose_name': <The model's verbose name>,
+            'verbose_name_plural': <The model's plural verbose name>,
+            'count': <The number of referencing objects>,
+            'objects': [<The unicode of up to ``limit`` of them>],
+            'has_more': <True if there are more than listed>
+        }
+
+    ``exclude`` is an object which isn't counted, e.g. a draft copy of
+    ``obj``. ``limit`` defaults to ``WORKFLOW_REFERENCE_PREVIEW_LIMIT``.
+    """
+    limit = limit or REFERENCE_PREVIEW_LIMIT
+    if not REFERENCE_PREVIEW_TIMEOUT:
+        return _build_preview(obj, exclude, limit)
+    key = _get_cache_key(obj, exclude, limit)
+    preview = cache.get(key)
+    if preview is None:
+        preview = _build_preview(obj, exclude, limit)
+        cache.set(key, preview, REFERENCE_PREVIEW_TIMEOUT)
+    return preview
+
+def expire_reference_previews(model, pks):
+    """
+    Forget the cached reference previews of the objects of ``model`` with the
+    primary keys ``pks``.
+    """
+    if REFERENCE_PREVIEW_TIMEOUT and pks:
+        bump_tags(*[_get_tag(model, pk) for pk in set(pks)])
+
+
+def _get_concrete_model(model):
+    # Deferred-field models are generated proxies of the model they defer.
+    if getattr(model, '_deferred', False):
+        return model._meta.proxy_for_model
+    return model
+
+def _get_reference_fields(model):
+    # Return ``(FKs, generic FKs)`` of ``model``: ``(name, attname, workflow
+    # model)`` triples of the FKs to workflow models, and ``(content type
+    # name, content type attname, object id name)`` triples of its generic
+    # FKs.
+    from threespot.workflow.models import BaseWorkflowMixin
+    model = _get_concrete_model(model)
+    if model not in _reference_fields:
+        opts = model._meta
+        fks = [(f.name, f.attname, f.rel.to) for f in opts.fields \
+            if f.rel and isinstance(f.rel.to, type) \
+            and issubclass(f.rel.to, BaseWorkflowMixin) \
+            and f.rel.get_related_field().primary_key
+        ]
+        generic_fks = [
+            (f.ct_field, opts.get_field(f.ct_field).attname, f.fk_field) \
+                for f in opts.virtual_fields
+        ]
+        _reference_fields[model] = (fks, generic_fks)
+    return _reference_fields[model]
+
+def _get_references(values, fks, generic_fks):
+    # Return the ``(workflow model, pk)`` pairs in ``values``, a dictionary
+    # of field values by name or attname. Missing values are left out.
+    from threespot.workflow.models import BaseWorkflowMixin
+    references = set()
+    for name, attname, model in fks:
+        pk = values.get(attname, values.get(name))
+        if pk is not None:
+            references.add((model, pk))
+    for ct_name, ct_attname, fk_name in generic_fks:
+        ctype_id = values.get(ct_attname, values.get(ct_name))
+        object_id = values.get(fk_name)
+        if ctype_id is None or object_id is None:
+            continue
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        if model is not None and issubclass(model, BaseWorkflowMixin):
+            references.add((model, object_id))
+    return references
+
+def _get_stored_references(model, pk, fks, generic_fks):
+    # Return the references of the stored object of ``model`` with the
+    # primary key ``pk``, in one query.
+    names = [name for name, _, _ in fks]
+    for ct_name, _, fk_name in generic_fks:
+        names.extend([ct_name, fk_name])
+    rows = model._base_manager.filter(pk=pk).values(*names)[:1]
+    if not rows:
+        return set()
+    return _get_references(rows[0], fks, generic_fks)
+
+def _expire_references(references):
+    pks_by_model = {}
+    for model, pk in references:
+        pks_by_model.setdefault(model, []).append(pk)
+    for model, pks in pks_by_model.items():
+        expire_reference_previews(model, pks)
+
+def _record_saved(sender, instance, **kwargs):
+    # The objects referred to before the change are affected as well, so
+    # they're read before an existing object is saved.
+    fks, generic_fks = _get_reference_fields(sender)
+    if (fks or generic_fks) and instance.pk is not None:
+        instance._workflow_references = _get_stored_references(
+            _get_concrete_model(sender), instance.pk, fks, generic_fks
+        )
+
+def _record_deleted(sender, instance, **kwargs):
+    # Deferred fields would be loaded one query at a time, if at all.
+    fks, generic_fks = _get_reference_fields(sender)
+    if instance.pk is None:
+        return
+    attnames = [attname for _, attname, _ in fks]
+    for _, ct_attname, fk_name in generic_fks:
+        attnames.extend([ct_attname, fk_name])
+    if [a for a in attnames if a not in instance.__dict__]:
+        instance._workflow_references = _get_stored_references(
+            _get_concrete_model(sender), instance.pk, fks, generic_fks
+        )
+
+def _expire_saved_or_deleted(sender, instance, **kwargs):
+    fks, generic_fks = _get_reference_fields(sender)
+    if not (fks or generic_fks):
+        return
+    references = _get_references(instance.__dict__, fks, generic_fks)
+    references.update(instance.__dict__.pop('_workflow_references', ()))
+    _expire_references(references)
+
+def _get_m2m_field(instance, through):
+    for field in instance._meta.many_to_many:
+        if field.rel.through == through:
+            return field
+    return None
+
+def _expire_m2m_changed(sender, instance, action, reverse, model, pk_set,\
+    **kwargs):
+    # Changing the rows of an intermediary table sends no ``post_save`` or
+    # ``post_delete`` signals for them. A relation is cleared before it's
+    # assigned to, so its rows are read before they're deleted.
+    from threespot.workflow.models import BaseWorkflowMixin
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        if isinstance(instance, BaseWorkflowMixin):
+            expire_reference_previews(instance.__class__, [instance.pk])
+    elif issubclass(model, BaseWorkflowMixin):
+        if action == 'pre_clear':
+            field = _get_m2m_field(instance, sender)
+            if field is None:
+                return
+            pk_set = sender._base_manager.filter(**{
+                field.m2m_field_name(): instance.pk
+            }).values_list(field.m2m_reverse_field_name(), flat=True)
+        expire_reference_previews(model, list(pk_set or ()))
+
+if REFERENCE_PREVIEW_TIMEOUT:
+    pre_save.connect(_record_saved)
+    post_save.connect(_expire_saved_or_deleted)
+    pre_delete.connect(_record_deleted)
+    post_delete.connect(_expire_saved_or_deleted)
+    m2m_changed.connect(_expire_m2m_changed)
@@ -0,0 +1,149 @@
+import heapq
+import time
+from datetime import timedelta
+
+from django.db import connections, models, reset_queries
+
+from threespot.workflow.app_settings import ENABLE_POSTDATED_PUBLISHING, \
+    PUBLISHED_STATE
+from threespot.workflow.models import BaseWorkflowMixin
+from threespot.workflow.signals import became_published
+from threespot.workflow.utils import get_current_datetime, \
+    get_go_live_datetime, quantize_datetime
+
+"""
+The publish scheduler keeps a heap of the times at which postdated, published
+objects of every workflow model go live, and sends the ``became_published``
+signal for each object at its time. It is run by the ``run_publish_scheduler``
+management command.
+"""
+
+def get_postdated_models():
+    """
+    Return the workflow models with postdated publishing, i.e. those with a
+    ``get_latest_by`` field (if ``ENABLE_POSTDATED_PUBLISHING`` is on).
+    Proxies and multi-table subclasses, which share the ``status`` field of
+    another model, are left out so that each object is only listed once.
+    """
+    if not ENABLE_POSTDATED_PUBLISHING:
+        return []
+    return [m for m in models.get_models() \
+        if issubclass(m, BaseWorkflowMixin) and m._meta.get_latest_by \
+        and not m._meta.proxy \
+        and 'status' in [f.name for f in m._meta.local_fields]
+    ]
+
+
+class PublishScheduler(object):
+    """
+    Schedules the ``became_published`` signal for postdated objects.
+
+    ``load`` (re)builds the heap of upcoming go-live times from the database,
+    and ``run_pending`` sends the signal for every object whose time has
+    come. Objects are checked again before the signal is sent, in case they
+    were unpublished or redated since the heap was built.
+
+    ``fired_until`` is the time up to which the signal has been sent: ``load``
+    picks up the objects which went live after it, so that objects created
+    between two loads with a go-live time before the second are still sent.
+    """
+
+    def __init__(self, models=None):
+        self.models = dict(
+            ('%s.%s' % (m._meta.app_label, m._meta.object_name), m) \
+                for m in (models or get_postdated_models())
+        )
+        self.heap = []
+        self.fired_until = None
+
+    def load(self, since=None):
+        """
+        Rebuild the heap with every object which goes live after ``since``,
+        which defaults to ``fired_until``, or to now on the first load.
+        """
+        if since is None:
+            since = self.fired_until or get_current_datetime()
+        if self.fired_until is None:
+            self.fired_until = since
+        # An object goes live after ``since`` if its date is after ``since``
+        # rounded down by the ``PUBLISH_TIME_QUANTUM`` setting.
+        since = quantize_datetime(since)
+        heap = []
+        for label, model in self.models.items():
+            manager = model._default_manager
+            field_name = model._meta.get_latest_by
+            upcoming = manager.filter(**{
+                'status': PUBLISHED_STATE,
+                field_name + '__gt': since
+            }).values_list('pk', field_name)
+            for pk, date_val in upcoming:
+                heap.append((get_go_live_datetime(date_val), label, pk))
+        heapq.heapify(heap)
+        self.heap = heap
+        return len(heap)
+
+    def next_datetime(self):
+        """ Return the next go-live time, or None if there isn't one."""
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def run_pending(self, now=None):
+        """
+        Send ``became_published`` for every object whose go-live time is no
+        later than ``now``. Returns the objects the signal was sent for.
+        """
+        if now is None:
+            now = get_current_datetime()
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            go_live, label, pk = heapq.heappop(self.heap)
+            due.setdefault(label, []).append(pk)
+        published = []
+        for label, pks in due.items():
+            model = self.models[label]
+            field_name = model._meta.get_latest_by
+            # One query per model for all of its due objects.
+            for obj in model._default_manager.filter(
+                pk__in=pks, status=PUBLISHED_STATE):
+                if get_go_live_datetime(getattr(obj, field_name)) <= now:
+                    became_published.send(sender=model, instance=obj)
+                    published.append(obj)
+        if self.fired_until is None or now > self.fired_until:
+            self.fired_until = now
+        return published
+
+    def run(self, refresh_interval=300, max_sleep=60, verbosity=1,\
+        stdout=None):
+        """
+        Run until interrupted, reloading the heap every ``refresh_interval``
+        seconds to pick up objects created or redated since, and sleeping for
+        at most ``max_sleep`` seconds at a time.
+        """
+        next_load = None
+        while True:
+            now = get_current_datetime()
+            if next_load is None or now >= next_load:
+                count = self.load()
+                next_load = now + timedelta(seconds=refresh_interval)
+                if verbosity > 1 and stdout:
+                    stdout.write("%d objects scheduled.\n" % count)
+            published = self.run_pending(now)
+            if verbosity > 0 and stdout:
+                for obj in published:
+                    stdout.write("Published %s %s.\n" % (
+                        obj._meta.verbose_name, obj.pk
+                    ))
+            # End the transaction the queries were made in, so that the next
+            # ones see the rows committed meanwhile (notably under MySQL's
+            # REPEATABLE READ), and don't keep a log of them under DEBUG.
+            for connection in connections.all():
+                connection.close()
+            reset_queries()
+            wake = next_load
+            if self.next_datetime() is not None:
+                wake = min(wake, self.next_datetime())
+            delta = wake - get_current_datetime()
+            seconds = delta.days * 86400 + delta.seconds + \
+                delta.microseconds / 1000000.0
+            time.sleep(max(0, min(seconds, max_sleep)))
@@ -0,0 +1,16 @@
+from django.dispatch import Signal
+
+"""
+Signals sent by the workflow app.
+"""
+
+# Sent by the publish scheduler when a postdated, published object goes live,
+# with the object as ``instance``; ``sender`` is its model.
+became_published = Signal(providing_args=['instance'])
+
+# Sent by ``WorkflowQuerySet.publish()`` and ``unpublish()`` once they have
+# changed the status of a batch of objects, with the primary keys of the
+# changed objects as ``pks``; ``sender`` is their model. Unlike ``save()``,
+# these send no per-object signals.
+workflow_published = Signal(providing_args=['pks'])
+workflow_unpublished = Signal(providing_args=['pks'])
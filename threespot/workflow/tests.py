@@ -1,19 +1,34 @@
-from datetime import date, timedelta
+import logging
+from datetime import date, datetime, timedelta
+from StringIO import StringIO
 from django.conf import settings
 from django.conf.urls.defaults import include, patterns
 from django.core.urlresolvers import reverse
 from django.contrib import admin
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db import models
+from django.db import connection, models
+from django.db.models.signals import post_save, post_delete
 from django import forms
+from django.core.management import call_command
 from django.test import TestCase
 
+from threespot.cache.expire import get_template_cache_key
+from threespot.cache.tags import get_tag_versions
+from threespot.orm import introspect
+from threespot.workflow import expiry, indexes, managers, scheduler, utils
 from threespot.workflow.admin import WorkflowAdmin
+from threespot.workflow.drafts import copy_item, merge_item
 from threespot.workflow.app_settings import PUBLISHED_STATE
 from threespot.workflow.forms import WorkflowAdminFormMixin
-from threespot.workflow.models import WorkflowMixin
+from threespot.workflow.jobs import enqueue_merge, get_pending_job, \
+    run_pending_jobs
+from threespot.workflow.models import MergeJob, WorkflowMixin
+from threespot.workflow.references import get_reference_preview
+from threespot.workflow.signals import workflow_published, \
+    workflow_unpublished
 
 
 class TestArticle(WorkflowMixin, models.Model):
@@ -38,11 +53,69 @@ class TestDatedArticle(WorkflowMixin, models.Model):
         return self.title
 
 
+class TestDatedArticleCacheDependencies(expiry.CacheDependencies):
+    fragments = [('test_article', ['slug'])]
+    tags = ['article:%(pk)s']
+
+expiry.register(TestDatedArticle, TestDatedArticleCacheDependencies)
+
+
+class TestTimedArticle(WorkflowMixin, models.Model):
+    """A mock object for testing workflow"""
+    published = models.DateTimeField()
+    title = models.CharField(max_length=255)
+
+    class Meta:
+        get_latest_by = 'published'
+
+    def __unicode__(self):
+        return self.title
+
+
+class TestTimedSubArticle(TestTimedArticle):
+    """A multi-table subclass of a workflow model"""
+    subtitle = models.CharField(max_length=255, blank=True)
+
+
+class TestTimedProxyArticle(TestTimedArticle):
+    """A proxy of a workflow model"""
+
+    class Meta:
+        proxy = True
+
+
+class TestTimedArticleCacheDependencies(expiry.CacheDependencies):
+    tags = ['timed:%(pk)s']
+
+expiry.register(TestTimedArticle, TestTimedArticleCacheDependencies)
+
+
 class FKReferencingThing(models.Model):
     """ A mock object that has an FK to a worfklow object."""
     ref = models.ForeignKey('TestArticle')
 
 
+class VisibleManager(models.Manager):
+    def get_query_set(self):
+        return super(VisibleManager, self).get_query_set().filter(
+            visible=True
+        )
+
+
+class HiddenReferencingThing(models.Model):
+    """ A mock object hidden by its default manager unless visible."""
+    ref = models.ForeignKey('TestArticle')
+    visible = models.BooleanField(default=False)
+    objects = VisibleManager()
+
+
+class HiddenReferencingProxyThing(HiddenReferencingThing):
+    """ A proxy of a model referencing a workflow object."""
+
+    class Meta:
+        proxy = True
+
+
 class M2MReferencingThing(models.Model):
     """ A mock object that has an FK to a worfklow object."""
     ref = models.ManyToManyField('TestArticle')
@@ -155,6 +228,38 @@ class WorkflowTest(TestCase):
         article.publish()
         self.assertTrue(article.is_published())
     
+    def test_select_related(self):
+        """ Verify the select_related arguments the manager accepts."""
+        extract = TestArticle.objects._extract_select_related_args
+        self.assertEqual(extract(True), ([], {}))
+        self.assertEqual(extract(2), ([], {'depth': 2}))
+        self.assertEqual(extract(('copy_of',)), (('copy_of',), {}))
+        self.assertEqual(extract(['copy_of']), (['copy_of'], {}))
+        self.assertRaises(TypeError, extract, 'copy_of')
+        article = TestArticle(
+            slug = 'article',
+            title = 'Title',
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        self.assertEqual(
+            [a.pk for a in TestArticle.objects.published(
+                select_related=1, defer=['title']
+            )],
+            [article.pk]
+        )
+        if hasattr(models.query.QuerySet, 'prefetch_related'):
+            self.assertEqual(
+                [a.pk for a in TestArticle.objects.published(
+                    prefetch_related=['fkreferencingthing_set']
+                )],
+                [article.pk]
+            )
+        else:
+            self.assertRaises(TypeError, TestArticle.objects.published,
+                prefetch_related=['fkreferencingthing_set']
+            )
+    
     def test_postdated_publishing(self):
         """
         Verify that workflow status with postdated publishing works as
@@ -176,9 +281,15 @@ class WorkflowTest(TestCase):
                 TestDatedArticle.objects.published()
             ]
         )
+        self.assertFalse(
+            TestDatedArticle.objects.filter(pk=article.pk).published_subset()
+        )
         article.pubdate = date.today()
         article.save()
         self.assertTrue(article.is_published())
+        self.assertTrue(
+            TestDatedArticle.objects.filter(pk=article.pk).published_subset()
+        )
         self.assertTrue(
             article.pk in [a.pk for a in TestDatedArticle.objects.published()]
         )
@@ -339,6 +450,57 @@ class WorkflowTest(TestCase):
         ref_thing = GenericReferencingThing.objects.all()[0]
         self.assertEqual(ref_thing.content_object, articles[0])
 
+    def test_background_merge(self):
+        """
+        Verify that a queued merge preserves references once it has run.
+        """
+        self.login()
+        article = TestArticle(
+            slug = 'article',
+            title = 'Title',
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        ref_thing = FKReferencingThing(ref=article)
+        ref_thing.save()
+        self.client.post(
+            self.get_admin_url('copy', article),
+            {'id': article.pk}
+        )
+        draft_copy = TestArticle.objects.draft_copies()[0]
+        self.assertContains(
+            self.client.get(self.get_admin_url('merge', draft_copy)),
+            '1 fk referencing thing'
+        )
+        model_admin = admin.site._registry[TestArticle]
+        model_admin.merge_in_background = True
+        try:
+            response = self.client.post(
+                self.get_admin_url('merge', draft_copy),
+                {'id': article.pk}
+            )
+        finally:
+            model_admin.merge_in_background = False
+        # Nothing is merged until the job runs.
+        self.assertEqual(TestArticle.objects.count(), 2)
+        job = MergeJob.objects.get()
+        self.assertEqual(job.status, MergeJob.QUEUED)
+        self.assertTrue(response['Location'].endswith(
+            'merge-jobs/%s/' % job.pk
+        ))
+        self.assertEqual(run_pending_jobs(), [job])
+        job = MergeJob.objects.get()
+        self.assertEqual(job.status, MergeJob.DONE)
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(job.total, job.progress)
+        articles = TestArticle.objects.all()
+        self.assertEqual(len(articles), 1)
+        self.assertEqual(articles[0], draft_copy)
+        self.assertEqual(FKReferencingThing.objects.get().ref, draft_copy)
+        self.assertEqual(self.client.get(response['Location']).status_code,
+            200
+        )
+
     def test_admin_form(self):
         """ Verify the form prevents us from publishing a draft copy."""
         article = TestArticle(
@@ -367,4 +529,655 @@ class WorkflowTest(TestCase):
             "already published. If you want to publish this over top of the "
             "existing item, you can do so by merging it."
         )
-        self.assertTrue(expected_err_string in response.context['errors'][1])
\ No newline at end of file
+        self.assertTrue(expected_err_string in response.context['errors'][1])
+
+    def test_cache_expiry(self):
+        """
+        Verify that the caches depending on an object are expired when it's
+        published or unpublished, but not when a draft is edited.
+        """
+        article = TestDatedArticle(
+            slug = 'article',
+            title = 'Title',
+            pubdate = date.today()
+        )
+        article.save()
+        expiry.flush_expiry()
+        tag = 'article:%s' % article.pk
+        version = get_tag_versions([tag])[0]
+        article.title = 'A new title'
+        article.save()
+        expiry.flush_expiry()
+        self.assertEqual(get_tag_versions([tag])[0], version)
+        article.publish()
+        expiry.flush_expiry()
+        published_version = get_tag_versions([tag])[0]
+        self.assertNotEqual(published_version, version)
+        article.unpublish()
+        expiry.flush_expiry()
+        self.assertNotEqual(get_tag_versions([tag])[0], published_version)
+
+    def test_cache_expiry_changed_arguments(self):
+        """
+        Verify that changing the arguments an object's caches are keyed by
+        expires the caches of both the old and the new arguments.
+        """
+        article = TestDatedArticle(
+            slug = 'old-slug',
+            title = 'Title',
+            pubdate = date.today(),
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        expiry.flush_expiry()
+        keys = [get_template_cache_key('test_article', slug) \
+            for slug in ('old-slug', 'new-slug')
+        ]
+        cache.set_many(dict((key, 'cached') for key in keys))
+        article.slug = 'new-slug'
+        article.save()
+        expiry.flush_expiry()
+        self.assertEqual(cache.get_many(keys), {})
+
+    def test_flush_expiry_errors(self):
+        """
+        Verify that a batch which fails to expire doesn't keep the others
+        from being expired.
+        """
+        class BrokenCacheDependencies(expiry.CacheDependencies):
+            views = [('workflow-tests-no-such-view', ['pk'])]
+            tags = ['article:%(pk)s']
+        article = TestDatedArticle(
+            slug = 'article',
+            title = 'Title',
+            pubdate = date.today()
+        )
+        article.save()
+        tag = 'article:%s' % article.pk
+        version = get_tag_versions([tag])[0]
+        dependencies = expiry._registry[TestDatedArticle]
+        expiry._registry[TestDatedArticle] = BrokenCacheDependencies()
+        handler = logging.NullHandler()
+        expiry.logger.addHandler(handler)
+        try:
+            expiry.expire_objects([article])
+            expiry.flush_expiry()
+        finally:
+            expiry._registry[TestDatedArticle] = dependencies
+            expiry.logger.removeHandler(handler)
+        self.assertNotEqual(get_tag_versions([tag])[0], version)
+
+    def test_reference_preview(self):
+        """
+        Verify that reference previews are cached until a referencing object
+        changes.
+        """
+        article = TestArticle(
+            slug = 'article',
+            title = 'Title',
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        for i in range(3):
+            FKReferencingThing(ref=article).save()
+        preview = get_reference_preview(article, limit=2)
+        self.assertEqual(len(preview), 1)
+        self.assertEqual(preview[0]['count'], 3)
+        self.assertEqual(len(preview[0]['objects']), 2)
+        self.assertTrue(preview[0]['has_more'])
+        self.assertNumQueries(0, get_reference_preview, article, limit=2)
+        FKReferencingThing(ref=article).save()
+        preview = get_reference_preview(article, limit=2)
+        self.assertEqual(preview[0]['count'], 4)
+        thing = M2MReferencingThing()
+        thing.save()
+        thing.ref.add(article)
+        preview = get_reference_preview(article, limit=2)
+        self.assertEqual([group['count'] for group in preview], [4, 1])
+        # Saving other workflow objects, or references to them, leaves the
+        # cached preview alone.
+        other = TestArticle(slug='other', title='Other')
+        other.save()
+        FKReferencingThing(ref=other).save()
+        thing.ref.add(other)
+        other.save()
+        self.assertNumQueries(0, get_reference_preview, article, limit=2)
+        # Pointing a reference elsewhere expires both previews.
+        get_reference_preview(other, limit=2)
+        moved = FKReferencingThing.objects.filter(ref=article)[0]
+        moved.ref = other
+        moved.save()
+        self.assertEqual(get_reference_preview(article, limit=2)[0]['count'], 3)
+        self.assertEqual(get_reference_preview(other, limit=2)[0]['count'], 2)
+        # Clearing or assigning to a relation expires the previews of the
+        # objects it referred to, and of those it refers to.
+        def m2m_counts(obj):
+            return [group['count'] for group in get_reference_preview(obj) \
+                if group['verbose_name'] == M2MReferencingThing._meta.verbose_name
+            ]
+        self.assertEqual(m2m_counts(other), [1])
+        thing.ref.clear()
+        self.assertEqual(m2m_counts(article), [])
+        self.assertEqual(m2m_counts(other), [])
+        thing.ref = [other]
+        self.assertEqual(m2m_counts(other), [1])
+        thing.ref = [article]
+        self.assertEqual(m2m_counts(article), [1])
+        self.assertEqual(m2m_counts(other), [])
+
+    def test_publish_actions(self):
+        """
+        Verify that the publishing admin actions report the number of items
+        they changed, without counting them separately.
+        """
+        for i in range(3):
+            TestArticle(slug='article-%s' % i, title='Title').save()
+        article = TestArticle.objects.all()[0]
+        copy_item(article, slug_field='slug')
+        model_admin = admin.site._registry[TestArticle]
+        messages = []
+        model_admin.message_user = lambda request, message: \
+            messages.append(message)
+        try:
+            # Selecting the items, updating them and checking for draft
+            # copies.
+            with self.assertNumQueries(3):
+                model_admin.publish_items(None, TestArticle.objects.all())
+            model_admin.unpublish_items(None,
+                TestArticle.objects.filter(pk=article.pk)
+            )
+        finally:
+            del model_admin.message_user
+        self.assertEqual(messages, [
+            "3 items were successfully published. Any draft copies selected "
+            "were not published; to publish  these, merge them into the "
+            "original.",
+            "One item was successfully unpublished."
+        ])
+        self.assertEqual(TestArticle.objects.published().count(), 2)
+
+    def test_bulk_publishing(self):
+        """
+        Verify that bulk (un)publishing sends one signal with the primary
+        keys of the changed objects, and expires their caches.
+        """
+        articles = []
+        for i in range(3):
+            article = TestDatedArticle(
+                slug = 'article-%s' % i,
+                title = 'Title',
+                pubdate = date.today()
+            )
+            article.save()
+            articles.append(article)
+        articles[0].publish()
+        expiry.flush_expiry()
+        tag = 'article:%s' % articles[1].pk
+        version = get_tag_versions([tag])[0]
+        received = []
+        def receiver(sender, pks, **kwargs):
+            received.append((sender, sorted(pks)))
+        workflow_published.connect(receiver)
+        workflow_unpublished.connect(receiver)
+        try:
+            self.assertEqual(
+                TestDatedArticle.objects.all().publish(chunk_size=1), 2
+            )
+            expiry.flush_expiry()
+            self.assertEqual(received, [
+                (TestDatedArticle, [articles[1].pk, articles[2].pk])
+            ])
+            self.assertEqual(TestDatedArticle.objects.published().count(), 3)
+            self.assertNotEqual(get_tag_versions([tag])[0], version)
+            del received[:]
+            TestDatedArticle.objects.filter(pk=articles[0].pk).unpublish()
+            self.assertEqual(received, [(TestDatedArticle, [articles[0].pk])])
+        finally:
+            workflow_published.disconnect(receiver)
+            workflow_unpublished.disconnect(receiver)
+
+    def test_cache_expiry_within_quantum(self):
+        """
+        Verify that saving an object which goes live within the current
+        publishing time quantum expires its caches, but saving one which goes
+        live later doesn't.
+        """
+        quantum = expiry.PUBLISH_TIME_QUANTUM, utils.PUBLISH_TIME_QUANTUM
+        expiry.PUBLISH_TIME_QUANTUM = utils.PUBLISH_TIME_QUANTUM = 3600
+        try:
+            now = utils.get_current_datetime()
+            soon = TestTimedArticle(
+                title = 'Soon',
+                published = now - timedelta(seconds=1)
+            )
+            later = TestTimedArticle(
+                title = 'Later',
+                published = now + timedelta(hours=2)
+            )
+            soon.save()
+            later.save()
+            expiry.flush_expiry()
+            tags = ['timed:%s' % soon.pk, 'timed:%s' % later.pk]
+            versions = get_tag_versions(tags)
+            soon.publish()
+            later.publish()
+            expiry.flush_expiry()
+            new_versions = get_tag_versions(tags)
+            self.assertNotEqual(new_versions[0], versions[0])
+            self.assertEqual(new_versions[1], versions[1])
+        finally:
+            expiry.PUBLISH_TIME_QUANTUM, utils.PUBLISH_TIME_QUANTUM = quantum
+
+    def _create_referenced_articles(self):
+        # Three articles, referenced in every way but by each other.
+        articles = []
+        for i in range(3):
+            article = TestArticle(slug='article-%s' % i, title='Title')
+            article.save()
+            articles.append(article)
+        FKReferencingThing(ref=articles[0]).save()
+        FKReferencingThing(ref=articles[1]).save()
+        shared = M2MReferencingThing()
+        shared.save()
+        shared.ref.add(articles[0], articles[1])
+        single = M2MReferencingThing()
+        single.save()
+        single.ref.add(articles[1])
+        GenericReferencingThing(content_object=articles[0]).save()
+        GenericReferencingThing(content_object=articles[2]).save()
+        return articles
+
+    def test_bulk_referencing_objects(self):
+        """
+        Verify that the bulk reference lookups find what the lookups of each
+        object find, with a number of queries independent of the number of
+        objects.
+        """
+        articles = self._create_referenced_articles()
+        def keys(objects):
+            return sorted((obj.__class__.__name__, obj.pk) for obj in objects)
+        direct = introspect.get_referencing_objects_bulk(articles)
+        generic = introspect.get_generic_referencing_objects_bulk(articles)
+        for article in articles:
+            self.assertEqual(
+                keys(direct[article.pk]),
+                keys(introspect.get_referencing_objects(article))
+            )
+            self.assertEqual(
+                keys(generic[article.pk]),
+                keys(introspect.get_generic_referencing_objects(article))
+            )
+        self.assertEqual(len(direct[articles[1].pk]), 3)
+        self.assertEqual(len(generic[articles[2].pk]), 1)
+        # One query per FK and two per M2M relation; one per generic relation.
+        index = introspect._get_relation_index()
+        self.assertNumQueries(
+            sum(is_m2m and 2 or 1 for _, _, is_m2m in \
+                index['fields'][TestArticle]
+            ),
+            introspect.get_referencing_objects_bulk, articles
+        )
+        self.assertNumQueries(
+            sum(len(fields) for _, fields in index['generic']),
+            introspect.get_generic_referencing_objects_bulk, articles
+        )
+
+    def test_referencing_counts_and_previews(self):
+        """
+        Verify the counts and previews of the objects referencing an object,
+        and that they take one query per referencing model.
+        """
+        articles = self._create_referenced_articles()
+        article = articles[1]
+        # Warm the content type cache.
+        ContentType.objects.get_for_model(TestArticle)
+        with self.assertNumQueries(0):
+            querysets = introspect.get_referencing_querysets(article)
+        counts = dict((qs.model, qs.count()) for qs in querysets)
+        self.assertEqual(counts[FKReferencingThing], 1)
+        self.assertEqual(counts[M2MReferencingThing], 2)
+        self.assertEqual(counts[TestArticle], 0)
+        model_count = len(introspect.get_referencing_models(TestArticle))
+        generic_count = len(introspect.get_generic_referencing_models())
+        self.assertEqual(len(querysets), model_count)
+        with self.assertNumQueries(model_count + generic_count):
+            count = introspect.count_referencing_objects(articles[0])
+        self.assertEqual(count, 3)
+        with self.assertNumQueries(model_count):
+            count = introspect.count_referencing_objects(articles[0],
+                include_generic=False
+            )
+        self.assertEqual(count, 2)
+        with self.assertNumQueries(model_count + generic_count):
+            preview = introspect.preview_referencing_objects(article,
+                limit=1, fields=['id']
+            )
+        self.assertEqual(
+            [(group['model'], len(group['objects']), group['has_more']) \
+                for group in preview],
+            [(FKReferencingThing, 1, False), (M2MReferencingThing, 1, True)]
+        )
+        fk_thing = preview[0]['objects'][0]
+        self.assertEqual(fk_thing.pk,
+            FKReferencingThing.objects.get(ref=article).pk
+        )
+        self.assertFalse('ref_id' in fk_thing.__dict__)
+
+    def test_bulk_referencing_relationships(self):
+        """
+        Verify that the bulk relationship lookup finds what the lookup of
+        each referencing object finds, comparing FKs without queries.
+        """
+        articles = self._create_referenced_articles()
+        article = articles[1]
+        referencing = introspect.get_referencing_objects(article)
+        self.assertEqual(
+            introspect.lookup_referencing_object_relationships_bulk(
+                article, referencing
+            ),
+            [(obj, introspect.lookup_referencing_object_relationships(
+                article, obj
+            )) for obj in referencing]
+        )
+        fk_thing = FKReferencingThing.objects.get(ref=article)
+        self.assertNumQueries(0,
+            introspect.lookup_referencing_object_relationships,
+            article, fk_thing
+        )
+        # One query per M2M relation, however many objects there are.
+        self.assertNumQueries(1,
+            introspect.lookup_referencing_object_relationships_bulk,
+            article, referencing
+        )
+
+    def test_queryset_cache(self):
+        """
+        Verify that the request cache shares querysets between calls with
+        the same arguments, including empty lists.
+        """
+        managers._start_queryset_cache()
+        try:
+            for kwargs in ({}, {'only': []}, {'only': ['title']},
+                {'select_related': ('copy_of',), 'defer': ['slug']}):
+                self.assertTrue(
+                    TestArticle.objects.published(**kwargs) is \
+                        TestArticle.objects.published(**kwargs)
+                )
+            self.assertFalse(
+                TestArticle.objects.published(only=['title']) is \
+                    TestArticle.objects.published(only=['slug'])
+            )
+            self.assertFalse(
+                TestArticle.objects.published(select_related=True) is \
+                    TestArticle.objects.published(select_related=1)
+            )
+            published = TestArticle.objects.published()
+            managers.clear_queryset_cache(TestArticle)
+            self.assertFalse(TestArticle.objects.published() is published)
+        finally:
+            managers._stop_queryset_cache()
+
+    def test_queryset_cache_deferred_and_subclass(self):
+        """
+        Verify that saving or deleting an object loaded with ``only()``, or an
+        object of a multi-table subclass, forgets the cached querysets of its
+        model and of the models it inherits from.
+        """
+        article = TestArticle(slug='article', title='Title',
+            status=PUBLISHED_STATE
+        )
+        article.save()
+        sub_article = TestTimedSubArticle(title='Title',
+            published=datetime(2000, 1, 1), status=PUBLISHED_STATE
+        )
+        sub_article.save()
+        # The receivers are only connected with the setting on.
+        post_save.connect(managers._clear_model_queryset_cache)
+        post_delete.connect(managers._clear_model_queryset_cache)
+        managers._start_queryset_cache()
+        try:
+            published = TestArticle.objects.published()
+            deferred = TestArticle.objects.only('title').get(pk=article.pk)
+            self.assertTrue(getattr(deferred, '_deferred', False))
+            deferred.save()
+            self.assertFalse(TestArticle.objects.published() is published)
+            published = TestTimedArticle.objects.published()
+            sub_published = TestTimedSubArticle.objects.published()
+            sub_article.delete()
+            self.assertFalse(TestTimedArticle.objects.published() is published)
+            self.assertFalse(
+                TestTimedSubArticle.objects.published() is sub_published
+            )
+        finally:
+            managers._stop_queryset_cache()
+            post_save.disconnect(managers._clear_model_queryset_cache)
+            post_delete.disconnect(managers._clear_model_queryset_cache)
+
+    def test_publish_time_rounding(self):
+        """
+        Verify the rounding of the publishing time and of go-live times.
+        """
+        value = datetime(2012, 3, 4, 10, 20, 30, 500000)
+        quantize = utils.quantize_datetime
+        # A quantum of one second only drops the microseconds.
+        self.assertEqual(quantize(value, 1), value.replace(microsecond=0))
+        self.assertEqual(quantize(value, 1, ceiling=True),
+            datetime(2012, 3, 4, 10, 20, 31)
+        )
+        self.assertEqual(quantize(value, 0), value)
+        self.assertEqual(quantize(value, 60), datetime(2012, 3, 4, 10, 20))
+        self.assertEqual(quantize(value, 60, ceiling=True),
+            datetime(2012, 3, 4, 10, 21)
+        )
+        # Values on a boundary aren't moved.
+        boundary = datetime(2012, 3, 4, 10, 20)
+        self.assertEqual(quantize(boundary, 60, ceiling=True), boundary)
+        # Multiples of a quantum which doesn't divide a minute are counted
+        # from midnight: 37210 seconds is 5315 * 7 + 5.
+        self.assertEqual(quantize(datetime(2012, 3, 4, 10, 20, 10), 7),
+            datetime(2012, 3, 4, 10, 20, 5)
+        )
+        self.assertEqual(
+            quantize(datetime(2012, 3, 4, 10, 20, 10), 7, ceiling=True),
+            datetime(2012, 3, 4, 10, 20, 12)
+        )
+        get_current_datetime = utils.get_current_datetime
+        quantum = utils.PUBLISH_TIME_QUANTUM
+        utils.get_current_datetime = lambda: value
+        utils.PUBLISH_TIME_QUANTUM = 60
+        try:
+            self.assertEqual(utils.get_publish_datetime(),
+                datetime(2012, 3, 4, 10, 20)
+            )
+            # Content goes live at the first publishing time at or after its
+            # date, and dates go live at midnight.
+            self.assertEqual(utils.get_go_live_datetime(value),
+                datetime(2012, 3, 4, 10, 21)
+            )
+            self.assertEqual(utils.get_go_live_datetime(boundary), boundary)
+            self.assertEqual(
+                utils.get_go_live_datetime(boundary + timedelta(microseconds=1)),
+                datetime(2012, 3, 4, 10, 21)
+            )
+            self.assertEqual(utils.get_go_live_datetime(date(2012, 3, 4)),
+                datetime(2012, 3, 4)
+            )
+        finally:
+            utils.get_current_datetime = get_current_datetime
+            utils.PUBLISH_TIME_QUANTUM = quantum
+
+    def test_publish_scheduler(self):
+        """
+        Verify that the scheduler sends ``became_published`` once for each
+        object, including objects which went live between two loads.
+        """
+        postdated = scheduler.get_postdated_models()
+        self.assertTrue(TestTimedArticle in postdated)
+        self.assertFalse(TestTimedSubArticle in postdated)
+        self.assertFalse(TestTimedProxyArticle in postdated)
+        start = utils.get_current_datetime().replace(microsecond=0)
+        clock = [start]
+        get_current_datetime = scheduler.get_current_datetime
+        scheduler.get_current_datetime = lambda: clock[0]
+        try:
+            publish_scheduler = scheduler.PublishScheduler()
+            publish_scheduler.load()
+            # Created after the load, going live before the next one.
+            article = TestTimedArticle(
+                title = 'Article',
+                published = start + timedelta(seconds=1),
+                status = PUBLISHED_STATE
+            )
+            article.save()
+            sub_article = TestTimedSubArticle(
+                title = 'Sub-article',
+                published = start + timedelta(seconds=1),
+                status = PUBLISHED_STATE
+            )
+            sub_article.save()
+            clock[0] = start + timedelta(seconds=2)
+            publish_scheduler.load()
+            published = publish_scheduler.run_pending(clock[0])
+            self.assertEqual(sorted(obj.pk for obj in published),
+                sorted([article.pk, sub_article.pk])
+            )
+            self.assertEqual(publish_scheduler.run_pending(clock[0]), [])
+            publish_scheduler.load()
+            self.assertEqual(publish_scheduler.run_pending(clock[0]), [])
+        finally:
+            scheduler.get_current_datetime = get_current_datetime
+
+    def test_run_publish_scheduler_command(self):
+        """
+        Verify that the command publishes the objects which went live in the
+        last ``--since`` minutes.
+        """
+        now = utils.get_current_datetime()
+        recent = TestTimedArticle(
+            title = 'Recent',
+            published = now - timedelta(minutes=1),
+            status = PUBLISHED_STATE
+        )
+        recent.save()
+        TestTimedArticle(
+            title = 'Old',
+            published = now - timedelta(minutes=10),
+            status = PUBLISHED_STATE
+        ).save()
+        stdout = StringIO()
+        call_command('run_publish_scheduler', since=5, stdout=stdout)
+        self.assertEqual(stdout.getvalue(),
+            "Published test timed article %s.\n" % recent.pk
+        )
+
+    def test_cache_expiry_deferred(self):
+        """
+        Verify that saving an object loaded with deferred fields expires its
+        caches.
+        """
+        article = TestDatedArticle(
+            slug = 'article',
+            title = 'Title',
+            pubdate = date.today(),
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        expiry.flush_expiry()
+        tag = 'article:%s' % article.pk
+        for kwargs in ({'defer': ['title']}, {'only': ['title']}):
+            version = get_tag_versions([tag])[0]
+            deferred = TestDatedArticle.objects.published(**kwargs)[0]
+            self.assertFalse(deferred.__class__ is TestDatedArticle)
+            self.assertTrue(expiry.is_registered(deferred.__class__))
+            deferred.title = 'A new title'
+            deferred.save()
+            expiry.flush_expiry()
+            self.assertNotEqual(get_tag_versions([tag])[0], version)
+
+    def test_status_date_indexes(self):
+        """
+        Verify that only the tables holding the status and date columns are
+        indexed, and that syncdb has indexed them.
+        """
+        indexed = indexes.get_indexed_models()
+        self.assertTrue(TestTimedArticle in indexed)
+        self.assertTrue(TestDatedArticle in indexed)
+        self.assertFalse(TestTimedSubArticle in indexed)
+        self.assertFalse(TestTimedProxyArticle in indexed)
+        self.assertEqual(indexes.get_missing_indexes(TestTimedArticle), [])
+        cursor = connection.cursor()
+        index_columns = indexes._get_index_columns(cursor, connection,
+            TestTimedSubArticle._meta.db_table
+        )
+        self.assertFalse([name for name in index_columns \
+            if name.endswith('status_date_idx') \
+            or name.endswith('published_date_idx')
+        ])
+
+    def test_merge_hidden_references(self):
+        """
+        Verify that references hidden by a filtering default manager are
+        repointed on merge rather than deleted with the original.
+        """
+        article = TestArticle(
+            slug = 'article',
+            title = 'Title',
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        hidden = HiddenReferencingThing(ref=article)
+        hidden.save()
+        draft_copy = copy_item(article, slug_field='slug')
+        merge_item(article, draft_copy, slug_field='slug')
+        hidden = HiddenReferencingThing._base_manager.get(pk=hidden.pk)
+        self.assertEqual(hidden.ref_id, draft_copy.pk)
+
+    def test_merge_proxy_references(self):
+        """
+        Verify that references are repointed and counted once, not again for
+        each proxy of the referencing model.
+        """
+        article = TestArticle(
+            slug = 'article',
+            title = 'Title',
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        thing = HiddenReferencingThing(ref=article, visible=True)
+        thing.save()
+        draft_copy = copy_item(article, slug_field='slug')
+        enqueue_merge(article, draft_copy, slug_field='slug')
+        run_pending_jobs()
+        job = MergeJob.objects.get()
+        self.assertEqual(job.status, MergeJob.DONE)
+        self.assertEqual((job.total, job.progress), (1, 1))
+        thing = HiddenReferencingProxyThing.objects.get(pk=thing.pk)
+        self.assertEqual(thing.ref_id, draft_copy.pk)
+
+    def test_stale_merge_job(self):
+        """
+        Verify that a running merge job abandoned by its worker is queued
+        again and run.
+        """
+        article = TestArticle(
+            slug = 'article',
+            title = 'Title',
+            status = PUBLISHED_STATE
+        )
+        article.save()
+        M2MReferencingThing().save()
+        for thing in M2MReferencingThing.objects.all():
+            thing.ref.add(article)
+        FKReferencingThing(ref=article).save()
+        draft_copy = copy_item(article, slug_field='slug')
+        job = enqueue_merge(article, draft_copy, slug_field='slug')
+        long_ago = utils.get_current_datetime() - timedelta(days=1)
+        MergeJob.objects.filter(pk=job.pk).update(
+            status=MergeJob.RUNNING, started=long_ago, heartbeat=long_ago
+        )
+        self.assertEqual(get_pending_job(draft_copy).status, MergeJob.QUEUED)
+        self.assertEqual(run_pending_jobs(), [job])
+        job = MergeJob.objects.get()
+        self.assertEqual(job.status, MergeJob.DONE)
+        self.assertEqual((job.total, job.progress), (2, 2))
+        self.assertEqual(get_pending_job(draft_copy), None)
@@ -1,7 +1,9 @@
-from datetime import datetime
+from datetime import datetime, time, timedelta
 
 from django.conf import settings
 
+from threespot.workflow.app_settings import PUBLISH_TIME_QUANTUM
+
 
 def get_current_datetime():
     """
@@ -13,4 +15,43 @@ def get_current_datetime():
         from django.utils import timezone
         return timezone.now()
     else:
-        return datetime.now()
\ No newline at end of file
+        return datetime.now()
+
+
+def quantize_datetime(value, quantum=None, ceiling=False):
+    """
+    Round a datetime down (or, if ``ceiling`` is True, up) to a multiple of
+    ``quantum`` seconds since midnight. ``quantum`` defaults to the
+    ``PUBLISH_TIME_QUANTUM`` setting.
+    """
+    if quantum is None:
+        quantum = PUBLISH_TIME_QUANTUM
+    if not quantum:
+        return value
+    midnight = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    delta = value - midnight
+    seconds = delta.seconds - delta.seconds % quantum
+    quantized = midnight + timedelta(seconds=seconds)
+    if ceiling and quantized < value:
+        quantized += timedelta(seconds=quantum)
+    return quantized
+
+def get_publish_datetime():
+    """
+    Return the "now" that postdated content is published by: the current
+    datetime, rounded down by the ``PUBLISH_TIME_QUANTUM`` setting.
+    """
+    return quantize_datetime(get_current_datetime())
+
+def get_go_live_datetime(value):
+    """
+    Return the datetime at which content postdated to ``value`` (a date or a
+    datetime) is published, taking ``PUBLISH_TIME_QUANTUM`` into account.
+    """
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+        if hasattr(settings, 'USE_TZ') and settings.USE_TZ:
+            from django.utils import timezone
+            value = timezone.make_aware(value, timezone.get_current_timezone())
+        return value
+    return quantize_datetime(value, ceiling=True)